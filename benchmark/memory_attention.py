@@ -0,0 +1,77 @@
+"""
+Compare the dense and the topk attention of the external memory in speed and in the difference of their results.
+Run from the root of the repository:
+    python -m benchmark.memory_attention --memory_sizes 1000,10000,100000
+"""
+import argparse
+import time
+import torch
+from model.decoder.memory import ExternalMemory
+
+
+def timeit(fn, repeat: int, device: torch.device) -> float:
+    """the average time of calling fn in seconds"""
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeat
+
+
+def bench(memory_size: int, args, device: torch.device):
+    dense = ExternalMemory(cascade_dim=args.dim, device=device, memory_size=memory_size).to(device)
+    topk = ExternalMemory(cascade_dim=args.dim, device=device, memory_size=memory_size, attention='topk',
+                          topk=args.topk, chunk_size=args.chunk).to(device)
+    topk.load_state_dict(dense.state_dict())
+    memory = torch.randn(memory_size, args.dim, device=device)
+    for external_memory in [dense, topk]:
+        external_memory.initialize_memory(memory)
+    query = torch.randn(args.batch, args.dim, device=device)
+
+    def step(external_memory):
+        def run():
+            if args.backward:
+                # every backward pass consumes the graph of the projected memory, project it again as a new
+                # solve would
+                external_memory.invalidate()
+                external_memory.zero_grad()
+                external_memory.attend(query.requires_grad_(True)).sum().backward()
+            else:
+                with torch.no_grad():
+                    external_memory.attend(query)
+        return run
+
+    with torch.no_grad():
+        expected, result = dense.attend(query), topk.attend(query)
+    error = (result - expected).abs()
+    return {'memory_size': memory_size, 'dense': timeit(step(dense), args.repeat, device),
+            'topk': timeit(step(topk), args.repeat, device), 'max_abs_error': error.max().item(),
+            'rel_error': (error.norm() / expected.norm()).item()}
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark of the attention over the external memory')
+    parser.add_argument('--memory_sizes', type=str, default='1000,10000,100000', help='memory sizes to benchmark')
+    parser.add_argument('--batch', type=int, default=256, help='number of queries')
+    parser.add_argument('--dim', type=int, default=64, help='dimensions of the cascade representation')
+    parser.add_argument('--topk', type=int, default=32, help='number of slots attended by each query')
+    parser.add_argument('--chunk', type=int, default=4096, help='number of slots scored at once')
+    parser.add_argument('--repeat', type=int, default=20, help='number of timed calls')
+    parser.add_argument('--backward', action='store_true', help='time the backward pass as well')
+    parser.add_argument('--gpu', type=int, default=0, help='idx for the gpu to use')
+    args = parser.parse_args()
+    device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    print(f'{"memory_size":>12} {"dense(ms)":>10} {"topk(ms)":>10} {"max_abs_err":>12} {"rel_err":>10}')
+    for memory_size in map(int, args.memory_sizes.split(',')):
+        result = bench(memory_size, args, device)
+        print(f'{result["memory_size"]:>12} {result["dense"] * 1000:>10.3f} {result["topk"] * 1000:>10.3f} '
+              f'{result["max_abs_error"]:>12.3e} {result["rel_error"]:>10.3e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare the ODE dynamics evaluated through the submodules, as one fused function and compiled by torch.compile, in
+the time of one function evaluation (NFE).
+Run from the root of the repository:
+    python -m benchmark.ode_dynamics --batch 256 --dim 64
+"""
+import argparse
+import time
+import torch
+from model.decoder.memory import ExternalMemory
+from model.decoder.diffeq_solver import CasODEFunc
+
+
+def timeit(fn, repeat: int, warmup: int, device: torch.device) -> float:
+    """the average time of calling fn in seconds"""
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeat
+
+
+def build(args, self_evolution: bool, compile_mode: str, device: torch.device) -> CasODEFunc:
+    torch.manual_seed(0)
+    external_memory = ExternalMemory(cascade_dim=args.dim, device=device, memory_size=args.memory_size)
+    ode_func = CasODEFunc(args.dim, args.dim, device=device, external_memory=external_memory,
+                          params={'self_evolution': self_evolution}, compile_mode=compile_mode).to(device)
+    ode_func.eval()
+    external_memory.initialize_memory(torch.randn(args.memory_size, args.dim, device=device))
+    return ode_func
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark of the compiled ODE dynamics')
+    parser.add_argument('--batch', type=int, default=256, help='number of cascades')
+    parser.add_argument('--dim', type=int, default=64, help='dimensions of the cascade state')
+    parser.add_argument('--memory_size', type=int, default=16, help='external memory size')
+    parser.add_argument('--repeat', type=int, default=200, help='number of timed evaluations')
+    parser.add_argument('--warmup', type=int, default=20, help='number of evaluations before timing')
+    parser.add_argument('--gpu', type=int, default=0, help='idx for the gpu to use')
+    args = parser.parse_args()
+    device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() else 'cpu')
+    z = torch.randn(args.batch, args.dim, device=device)
+    t = torch.zeros((), device=device)
+    modes = ['none', 'fused', 'compile']
+    print(f'{"dynamics":>15} {"pass":>9} ' + ' '.join(f'{mode + "(us)":>13}' for mode in modes) + f' {"max_err":>10}')
+    for self_evolution in [False, True]:
+        ode_funcs = [build(args, self_evolution, mode, device) for mode in modes]
+        name = 'self_evolution' if self_evolution else 'external_memory'
+        for mode in ['forward', 'backward']:
+            def nfe(ode_func):
+                def run():
+                    if mode == 'forward':
+                        with torch.no_grad():
+                            return ode_func(t, z)
+                    # the adjoint method evaluates the dynamics with gradients in the backward pass
+                    y = z.detach().requires_grad_(True)
+                    out = ode_func(t, y)
+                    torch.autograd.grad(out, [y] + list(ode_func.parameters()), torch.ones_like(out),
+                                        allow_unused=True, retain_graph=True)
+                    return out
+                return run
+            with torch.no_grad():
+                error = max((ode_func(t, z) - ode_funcs[0](t, z)).abs().max().item() for ode_func in ode_funcs)
+            costs = [timeit(nfe(ode_func), args.repeat, args.warmup, device) for ode_func in ode_funcs]
+            print(f'{name:>15} {mode:>9} ' + ' '.join(f'{cost * 1e6:>13.1f}' for cost in costs) + f' {error:>10.2e}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compare the ODE solver backends on the cascade dynamics in the time of a forward and backward pass, and in the
+relative difference of their solutions and gradients from torchdiffeq with the adjoint method. The adjoint
+method integrates the adjoint ODE backward with the same solver, so its gradients differ from direct
+back-propagation by the discretization error of the solver.
+Run from the root of the repository:
+    python -m benchmark.ode_solver --methods euler,rk4
+"""
+import argparse
+import time
+import torch
+from model.decoder.memory import ExternalMemory
+from model.decoder.diffeq_solver import DiffeqSolver, CasODEFunc
+
+BACKENDS = [('torchdiffeq', True), ('torchdiffeq', False), ('fixed', True), ('fixed', False)]
+
+
+def build(args, device: torch.device) -> CasODEFunc:
+    external_memory = ExternalMemory(cascade_dim=args.dim, device=device, memory_size=args.memory_size)
+    ode_func = CasODEFunc(args.dim, args.dim, device=device, external_memory=external_memory,
+                          params={'self_evolution': False}, dropout=0.).to(device)
+    # disable the dropout inside the dynamics so that the backends solve the same ODE
+    ode_func.eval()
+    external_memory.initialize_memory(torch.randn(args.memory_size, args.dim, device=device))
+    return ode_func
+
+
+def run(solver: DiffeqSolver, first_point: torch.Tensor, time_steps: torch.Tensor):
+    """one forward and backward pass, return the solution and the gradients of the parameters"""
+    solver.ode_func.zero_grad()
+    solver.ode_func.cas_external_memory.external_memory.prepare()
+    first_point = first_point.detach().requires_grad_(True)
+    pred_y = solver(first_point, time_steps)
+    pred_y.square().mean().backward()
+    grads = [torch.zeros_like(param) if param.grad is None else param.grad.clone()
+             for param in solver.ode_func.parameters()]
+    return pred_y.detach(), torch.cat([grad.reshape(-1) for grad in grads] + [first_point.grad.reshape(-1)])
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark of the ODE solver backends')
+    parser.add_argument('--methods', type=str, default='euler,rk4', help='fixed-step methods to benchmark')
+    parser.add_argument('--batch', type=int, default=256, help='number of cascades')
+    parser.add_argument('--dim', type=int, default=64, help='dimensions of the cascade state')
+    parser.add_argument('--steps', type=int, default=24, help='number of time points to predict')
+    parser.add_argument('--memory_size', type=int, default=16, help='external memory size')
+    parser.add_argument('--repeat', type=int, default=10, help='number of timed passes')
+    parser.add_argument('--gpu', type=int, default=0, help='idx for the gpu to use')
+    args = parser.parse_args()
+    device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    ode_func = build(args, device)
+    first_point = torch.randn(args.batch, args.dim, device=device)
+    time_steps = torch.arange(args.steps, dtype=torch.float, device=device)
+    print(f'{"method":>8} {"backend":>12} {"adjoint":>8} {"time(ms)":>10} {"rel_y_err":>10} {"rel_grad_err":>12}')
+    for method in args.methods.split(','):
+        reference = None
+        for backend, adjoint in BACKENDS:
+            solver = DiffeqSolver(ode_func, method=method, device=device, backend=backend, adjoint=adjoint)
+            pred_y, grad = run(solver, first_point, time_steps)
+            if reference is None:
+                reference = (pred_y, grad)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                run(solver, first_point, time_steps)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            cost = (time.perf_counter() - start) / args.repeat
+            y_error = ((pred_y - reference[0]).norm() / reference[0].norm()).item()
+            grad_error = ((grad - reference[1]).norm() / reference[1].norm()).item()
+            print(f'{method:>8} {backend:>12} {str(adjoint):>8} {cost * 1000:>10.3f} {y_error:>10.3e} '
+                  f'{grad_error:>12.3e}')
+
+
+if __name__ == '__main__':
+    main()
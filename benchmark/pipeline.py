@@ -0,0 +1,157 @@
+"""
+Benchmark the whole pipeline on a synthetic dataset: the time of preprocessing, of one training epoch and of one
+inference pass, for every combination of the embedding modules and ODE solvers, written as JSON for regression
+tracking. The dataset is generated by utils.synthetic into data/synthetic.csv unless it exists, and it is
+preprocessed by `transformation` here, so neither the configuration nor the transformation of the real datasets
+is needed. The models use the dynamic states and the temporal aggregator, and the ODE counters are on to report the
+NFE of training.
+Run from the root of the repository:
+    python -m benchmark.pipeline --embeddings aggregate,identity --solvers euler,rk4,dopri5 --output bench.json
+Other arguments of the training script are passed after --, e.g. `-- --node_dim 32 --ode_backend fixed`.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import torch
+from torch.distributions.normal import Normal
+from model.NODEPT import NODEPT
+from train.train import train_epoch, predict_epoch
+from utils.arguments import get_parser
+from utils.data_processing import get_data
+from utils.synthetic import generate, save
+
+DATASET = 'synthetic'
+
+
+def synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def transformation(dataset, all_data, cas_popularity, time_unit, min_time, param):
+    """the counterpart of `data_transformation` for the synthetic dataset, the publication and absolute times are
+    in time units since the first publication"""
+    all_data['pub_time'] = (all_data['pub_time'] - min_time) / time_unit
+    all_data['abs_time'] = all_data['pub_time'] + all_data['time'] / time_unit
+    param['node_num'] = {'user': int(max(all_data['src'].max(), all_data['dst'].max())) + 1,
+                         'cas': int(all_data['cas'].max()) + 1}
+    param['max_global_time'] = float(all_data['pub_time'].max())
+    return cas_popularity
+
+
+def get_param(args, embedding: str, solver: str):
+    argv = ['--dataset', DATASET, '--embedding_module', embedding, '--solver', solver, '--bs', str(args.bs),
+            '--epoch', '1', '--no_cache', '--ode_stats', '--use_dynamic', '--use_temporal'] + args.train_args
+    param = vars(get_parser().parse_args(argv))
+    param.update({'observe_time': args.observe_time, 'predict_time': args.predict_time,
+                  'restruct_time': args.restruct_time, 'train_time': args.predict_time,
+                  'val_time': args.predict_time, 'test_time': args.predict_time, 'time_unit': args.time_unit,
+                  'use_structural': False})
+    return param
+
+
+def build_model(param, device: torch.device) -> NODEPT:
+    time_steps_to_predict = torch.tensor(np.arange(param['observe_time'], param['restruct_time']))
+    return NODEPT(args=param, device=device, node_dim=param['node_dim'],
+                  embedding_module_type=param['embedding_module'], state_updater_type='gru',
+                  predictor=param['predictor'], time_enc_dim=param['time_dim'],
+                  single=param['single'], ntypes={'user', 'cas'}, dropout=param['dropout'],
+                  n_nodes=param['node_num'], max_time=param['max_time'], use_static=param['use_static'],
+                  merge_prob=param['lambda'], max_global_time=param['max_global_time'],
+                  use_dynamic=param['use_dynamic'], use_temporal=param['use_temporal'],
+                  use_structural=param['use_structural'], time_steps_to_predict=time_steps_to_predict).to(device)
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark of the pipeline on a synthetic dataset')
+    parser.add_argument('--embeddings', type=str, default='aggregate,identity', help='embedding modules')
+    parser.add_argument('--solvers', type=str, default='euler,rk4,dopri5', help='ODE solvers')
+    parser.add_argument('--users', type=int, default=10000, help='number of users of the generated dataset')
+    parser.add_argument('--cascades', type=int, default=2000, help='number of cascades of the generated dataset')
+    parser.add_argument('--events', type=int, default=200000, help='number of events of the generated dataset')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the dataset and the models')
+    parser.add_argument('--regenerate', action='store_true', help='generate the dataset even if it exists')
+    parser.add_argument('--time_unit', type=int, default=3600, help='number of seconds of a time unit')
+    parser.add_argument('--observe_time', type=int, default=2, help='observation time in time units')
+    parser.add_argument('--predict_time', type=int, default=24, help='prediction time in time units')
+    parser.add_argument('--restruct_time', type=int, default=24, help='end of the predicted trajectory')
+    parser.add_argument('--bs', type=int, default=50, help='batch size')
+    parser.add_argument('--output', type=str, default='benchmark_pipeline.json', help='path of the results')
+    parser.add_argument('train_args', nargs='*', help='arguments of the training script, after --')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger('benchmark')
+
+    if args.regenerate or not os.path.exists(f'data/{DATASET}.csv'):
+        interactions, metadata = generate(args.users, args.cascades, args.events, time_unit=args.time_unit,
+                                          horizon=args.predict_time, seed=args.seed)
+        save(DATASET, interactions, metadata)
+    embeddings, solvers = args.embeddings.split(','), args.solvers.split(',')
+
+    # the preprocessing does not depend on the settings, it runs once and its updates of the parameters are shared
+    param = get_param(args, embeddings[0], solvers[0])
+    origin_param = dict(param)
+    start = time.perf_counter()
+    dataset, cas_labels = get_data(dataset=DATASET, observe_time=param['observe_time'],
+                                   predict_time=param['predict_time'], restruct_time=param['restruct_time'],
+                                   train_time=param['train_time'], val_time=param['val_time'],
+                                   test_time=param['test_time'], time_unit=param['time_unit'], log=logger,
+                                   param=param, transformation=transformation)
+    preprocess_time = time.perf_counter() - start
+    data_param = {key: value for key, value in param.items()
+                  if key not in origin_param or origin_param[key] is not value}
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    results = []
+    for embedding in embeddings:
+        for solver in solvers:
+            param = get_param(args, embedding, solver)
+            param.update(data_param)
+            torch.manual_seed(args.seed)
+            np.random.seed(args.seed)
+            model = build_model(param, device)
+            optimizer = torch.optim.Adam(model.parameters(), lr=param['lr'])
+            z0_prior = Normal(torch.Tensor([0.0]).to(device), torch.Tensor([1.]).to(device))
+            synchronize(device)
+            start = time.perf_counter()
+            train_loss, epoch_metric = train_epoch(model, dataset, cas_labels, optimizer, z0_prior, device, param)
+            synchronize(device)
+            train_time = time.perf_counter() - start
+            train_nfe = model.cas_ode.stats.counts['forward_nfe'] + model.cas_ode.stats.counts['backward_nfe']
+            start = time.perf_counter()
+            predict_metric = predict_epoch(model, dataset, cas_labels, device, param)
+            synchronize(device)
+            predict_time = time.perf_counter() - start
+            n_pred = sum(metric.count for metric in predict_metric.values()) / cas_labels.shape[1]
+            result = {'embedding': embedding, 'solver': solver, 'train_epoch_time': train_time,
+                      'train_nfe': train_nfe, 'train_loss': float(np.mean(train_loss)) if train_loss else None,
+                      'test_msle': epoch_metric['test'].result()['msle'], 'predict_time': predict_time,
+                      'predict_events_per_second': dataset.length / predict_time,
+                      'predict_cascades_per_second': n_pred / predict_time}
+            results.append(result)
+            logger.info(json.dumps(result))
+
+    report = {'dataset': {'users': args.users, 'cascades': args.cascades, 'events': args.events,
+                          'seed': args.seed, 'interactions': dataset.length, 'target_cascades': len(cas_labels)},
+              'environment': {'commit': get_commit(), 'torch': torch.__version__, 'python': platform.python_version(),
+                              'device': str(device), 'threads': torch.get_num_threads()},
+              'preprocess_time': preprocess_time, 'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    logger.info(f'wrote the results to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,12 @@ from model.encoder.embedding_module import get_embedding_module
 from model.encoder.message.message_generator import get_message_generator
 
 from model.time_encoder import get_time_encoder
-from utils.hgraph import HGraph
+from utils.cas_history import CasHistory
 from model.decoder.cas_ode import CasODE
 from model.encoder.encoder_z0 import EncodeZ0
 from model.decoder.memory import ExternalMemory
+from utils.validation import Validator
+from utils.profiler import StageProfiler
 
 
 class NODEPT(nn.Module):
@@ -31,18 +33,20 @@ class NODEPT(nn.Module):
         self.user_num = n_nodes['user']
         self.time_steps_to_predict = time_steps_to_predict.float().to(self.device)
         self.single = single
-        self.hgraph = HGraph(num_user=n_nodes['user'], num_cas=n_nodes['cas'])
+        self.history = CasHistory(num_user=n_nodes['user'], num_cas=n_nodes['cas'], device=device)
         self.time_encoder = get_time_encoder('difference', dimension=time_enc_dim, single=self.single)
         self.use_dynamic = use_dynamic
         self.node_dim = node_dim
         self.args = args
+        self.validator = Validator(args['check_level'], args['check_interval'])
+        self.profiler = StageProfiler(args['profile_stages'], device, trace=bool(args['profile_trace']))
         self.dynamic_state = nn.ModuleDict({
             'user': DynamicState(n_nodes['user'], state_dimension=node_dim,
                                  input_dimension=node_dim, message_dimension=node_dim,
-                                 device=device, single=False),
+                                 device=device, single=False, validator=self.validator),
             'cas': DynamicState(n_nodes['cas'], state_dimension=node_dim,
                                 input_dimension=node_dim, message_dimension=node_dim,
-                                device=device, single=True)})
+                                device=device, single=True, validator=self.validator)})
         self.init_state()
         self.message_generator = get_message_generator(generator_type='concat', state=self.dynamic_state,
                                                        time_encoder=self.time_encoder,
@@ -55,19 +59,24 @@ class NODEPT(nn.Module):
                                                state=self.dynamic_state,
                                                message_dimension=node_dim,
                                                state_dimension=node_dim,
-                                               device=self.device, single_updater=single, ntypes=ntypes)
+                                               device=self.device, single_updater=single, ntypes=ntypes,
+                                               validator=self.validator)
         self.embedding_module = get_embedding_module(module_type=embedding_module_type,
                                                      dynamic_state=self.dynamic_state, embedding_dimension=node_dim,
-                                                     device=self.device, dropout=dropout, hgraph=self.hgraph,
+                                                     device=self.device, dropout=dropout, history=self.history,
                                                      input_dimension=node_dim, max_time=max_time['cas'],
                                                      use_static=use_static, user_num=n_nodes['user'],
                                                      max_global_time=max_global_time, use_dynamic=use_dynamic,
-                                                     use_temporal=use_temporal, use_structural=use_structural)
+                                                     use_temporal=use_temporal, use_structural=use_structural,
+                                                     cas_num=n_nodes['cas'], temporal_mode=args['temporal_mode'],
+                                                     temporal_chunk=args['temporal_chunk'])
 
         self.encoder_z0 = EncodeZ0(emb_dim=node_dim)
-        self.external_memory = ExternalMemory(cascade_dim=node_dim, memory_size=args['memory_size'], device=device)
+        self.external_memory = ExternalMemory(cascade_dim=node_dim, memory_size=args['memory_size'], device=device,
+                                              attention=args['memory_attention'], topk=args['memory_topk'],
+                                              chunk_size=args['memory_chunk'])
         self.cas_ode = CasODE(ode_hidden_dim=node_dim, args=args, device=device, dropout=dropout,
-                              external_memory=self.external_memory)
+                              external_memory=self.external_memory, validator=self.validator)
 
     def update_state(self):
         if self.use_dynamic:
@@ -76,35 +85,55 @@ class NODEPT(nn.Module):
 
     def forward(self, source_nodes: np.ndarray, destination_nodes: np.ndarray, trans_cascades: np.ndarray,
                 edge_times: torch.Tensor, pub_times: torch.Tensor, target_idx: np.ndarray):
+        self.validator.step()
+        profiler = self.profiler
         if self.use_dynamic:
-            nodes, messages, times = self.message_generator.get_message(source_nodes, destination_nodes,
-                                                                        trans_cascades, edge_times, pub_times, 'all')
-            self.state_updater.update_state(nodes, messages, times)
-        self.hgraph.insert(trans_cascades, source_nodes, destination_nodes, edge_times,
-                           pub_times)
+            with profiler.stage('message'):
+                nodes, messages, times = self.message_generator.get_message(source_nodes, destination_nodes,
+                                                                            trans_cascades, edge_times, pub_times,
+                                                                            'all')
+            with profiler.stage('state_update'):
+                self.state_updater.update_state(nodes, messages, times)
+        with profiler.stage('history'):
+            self.history.insert(trans_cascades, destination_nodes, edge_times, pub_times)
+        with profiler.stage('embedding'):
+            self.embedding_module.advance(trans_cascades)
         target_cascades = trans_cascades[target_idx]
         pred = torch.zeros(len(trans_cascades), len(self.time_steps_to_predict)).to(self.device)
         first_point = torch.zeros(len(trans_cascades), self.node_dim, 2).to(self.device)
         if len(target_cascades) > 0:
-            emb = self.embedding_module.compute_embedding(target_cascades)
-            first_point_nor = self.encoder_z0(emb)
-            pred[target_idx], first_point[target_idx] = self.cas_ode.get_reconstruction(first_point_nor=first_point_nor,
-                                                                                        time_steps_to_predict=self.time_steps_to_predict)
+            with profiler.stage('embedding'):
+                emb = self.embedding_module.compute_embedding(target_cascades)
+            with profiler.stage('encoder_z0'):
+                first_point_nor = self.encoder_z0(emb)
+            with profiler.stage('ode'):
+                pred[target_idx], first_point[target_idx] = self.cas_ode.get_reconstruction(
+                    first_point_nor=first_point_nor, time_steps_to_predict=self.time_steps_to_predict)
             if self.args['self_evolution']:
                 pass
             else:
                 self.external_memory.update_memory(emb)
         return pred, first_point
 
+    def query(self, query_times: torch.Tensor) -> torch.Tensor:
+        """
+        Predict the popularity of the target cascades of the last forward at arbitrary times inside
+        [observe_time, restruct_time - 1] from the dense output of the last solve, without integrating again
+        :param query_times: the times to predict, in the same unit as the time steps to predict, tensor of shape (q)
+        :return: the predictions, tensor of shape (n_target, q)
+        """
+        return self.cas_ode.query(torch.as_tensor(query_times, dtype=torch.float, device=self.device))
+
     def init_state(self):
         for ntype in self.ntypes:
             self.dynamic_state[ntype].__init_state__()
-        self.hgraph.init()
+        self.history.init()
 
     def reset_state(self):
         for ntype in self.ntypes:
             self.dynamic_state[ntype].reset_state()
-        self.hgraph.init()
+        self.history.init()
+        self.embedding_module.reset_state()
 
     def detach_state(self):
         for ntype in self.ntypes:
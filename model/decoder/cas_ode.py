@@ -7,14 +7,22 @@ import torch.nn as nn
 from model.decoder.ode_fun import CasSelf
 from model.decoder.diffeq_solver import DiffeqSolver
 from model.decoder.diffeq_solver import CasODEFunc
+from model.decoder.ode_stats import OdeStats
+from utils.validation import Validator
 
 
 class CasODE(nn.Module):
-    def __init__(self, ode_hidden_dim, args, device,external_memory, output_dim=1,dropout=0.2):
+    def __init__(self, ode_hidden_dim, args, device,external_memory, output_dim=1,dropout=0.2, validator=None):
         super(CasODE, self).__init__()
         self.args = args
-        self.ode_fun = CasODEFunc(ode_hidden_dim, ode_hidden_dim, device=device,dropout=dropout,external_memory=external_memory,params=args)
-        self.diffeq_solver = DiffeqSolver(self.ode_fun, method=args['solver'])
+        self.validator = validator if validator is not None else Validator('off')
+        self.stats = OdeStats(args['ode_stats'], device)
+        self.ode_fun = CasODEFunc(ode_hidden_dim, ode_hidden_dim, device=device,dropout=dropout,external_memory=external_memory,params=args,
+                                  compile_mode=args['compile_ode'], validator=self.validator,
+                                  stats=self.stats)
+        self.diffeq_solver = DiffeqSolver(self.ode_fun, method=args['solver'], backend=args['ode_backend'],
+                                          adjoint=not args['no_adjoint'], dense_output=args['dense_output'],
+                                          stats=self.stats)
         self.decoder = Decoder(latent_dim=ode_hidden_dim, output_dim=output_dim)
         self.ode_hidden_dim = ode_hidden_dim
 
@@ -22,22 +30,23 @@ class CasODE(nn.Module):
     def get_reconstruction(self, first_point_nor, time_steps_to_predict):
         # Encoder:
         first_point_mu, first_point_std = first_point_nor
-        assert (not torch.isnan(first_point_std).any())
-        assert (not torch.isnan(first_point_mu).any())
+        if self.validator.enabled:
+            self.validator.check_nan('encoder z0', first_point_mu, first_point_std)
+            self.validator.check_nan('prediction time steps', time_steps_to_predict)
 
         first_point_enc = utils.sample_standard_gaussian(first_point_mu, first_point_std)
 
         first_point_std = first_point_std.abs()
 
-        assert (torch.sum(first_point_std < 0) == 0.)
-        assert (not torch.isnan(time_steps_to_predict).any())
-
-        assert (not torch.isnan(first_point_enc).any())
-
+        if self.validator.enabled:
+            self.validator.check_nan('z0 sampling', first_point_enc)
 
+        if not self.args['self_evolution']:
+            self.ode_fun.cas_external_memory.external_memory.prepare()
         sol_y = self.diffeq_solver(first_point_enc, time_steps_to_predict)
 
-        assert (not torch.isnan(sol_y).any())
+        if self.validator.enabled:
+            self.validator.check_nan('ode solver', sol_y)
 
         # Decoder:
         pred = self.decoder(sol_y)
@@ -48,6 +57,18 @@ class CasODE(nn.Module):
 
         return pred, first_point
 
+    def query(self, query_times):
+        """
+        Predict the popularity of the cascades of the last reconstruction at any times inside the solved interval,
+        by decoding the interpolated states instead of solving again. It needs the dense output of the solver
+        :param query_times: the times to predict, tensor of shape (q)
+        :return: the predictions, tensor of shape (n_cas, q)
+        """
+        if self.diffeq_solver.solution is None:
+            raise RuntimeError('no dense output is kept, enable dense_output and reconstruct first')
+        sol_y = self.diffeq_solver.solution(query_times).permute(1, 0, 2)
+        return self.decoder(sol_y).squeeze(dim=2)
+
 
 class Decoder(nn.Module):
     def __init__(self, latent_dim, output_dim, decoder_network=None):
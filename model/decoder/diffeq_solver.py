@@ -1,24 +1,143 @@
+import logging
 import torch
 import torch.nn as nn
-from torchdiffeq import odeint_adjoint as odeint
+from torch.utils.checkpoint import checkpoint
+from torchdiffeq import odeint, odeint_adjoint
 import numpy as np
 from model.decoder.ode_fun import CasSelf
 from model.decoder.ode_fun import CasExternalMemory
+from model.decoder.ode_stats import OdeStats
+from utils.validation import Validator
+
+try:
+    # the errors of torch.compile, a failing backend raises BackendCompilerFailed, a subclass
+    from torch._dynamo.exc import TorchDynamoException as CompileError
+except ImportError:
+    # without dynamo the dynamics are never compiled, so there is nothing to catch
+    CompileError = ()
+
+
+class DenseOutput:
+    """
+    The interpolant of a solved trajectory, which evaluates the states at any time inside the solved interval
+    without integrating again. The states are interpolated linearly between the time points when no derivatives are
+    given, and by cubic Hermite polynomials otherwise.
+    """
+
+    def __init__(self, t: torch.Tensor, y: torch.Tensor, dy: torch.Tensor = None):
+        """
+        :param t: the increasing time points of the solution, tensor of shape (t)
+        :param y: the states at the time points, tensor of shape (t, K*N, D)
+        :param dy: the derivatives of the states at the time points, tensor of shape (t, K*N, D)
+        """
+        self.t = t
+        self.y = y
+        self.dy = dy
+
+    def __call__(self, query_times: torch.Tensor) -> torch.Tensor:
+        """
+        :param query_times: the times to evaluate, tensor of shape (q)
+        :return: the states at the query times, tensor of shape (q, K*N, D)
+        """
+        query_times = torch.as_tensor(query_times, dtype=self.t.dtype, device=self.t.device)
+        if len(query_times) > 0 and (query_times.min() < self.t[0] or query_times.max() > self.t[-1]):
+            raise ValueError(f'query times should be inside the solved interval [{self.t[0]}, {self.t[-1]}]')
+        if len(self.t) == 1:
+            return self.y[[0] * len(query_times)]
+        # the index of the interval of each query time
+        idx = torch.searchsorted(self.t, query_times, right=True).clamp(1, len(self.t) - 1) - 1
+        h = (self.t[idx + 1] - self.t[idx]).reshape(-1, 1, 1)
+        s = (query_times - self.t[idx]).reshape(-1, 1, 1) / h
+        y0, y1 = self.y[idx], self.y[idx + 1]
+        if self.dy is None:
+            return y0 + s * (y1 - y0)
+        s2, s3 = s * s, s * s * s
+        return (2 * s3 - 3 * s2 + 1) * y0 + (s3 - 2 * s2 + s) * h * self.dy[idx] + \
+            (3 * s2 - 2 * s3) * y1 + (s3 - s2) * h * self.dy[idx + 1]
 
 
 class DiffeqSolver(nn.Module):
     def __init__(self, ode_func, method="euler",
-                 odeint_rtol=1e-3, odeint_atol=1e-4, device=torch.device("cpu")):
+                 odeint_rtol=1e-3, odeint_atol=1e-4, device=torch.device("cpu"), backend='torchdiffeq',
+                 adjoint=True, dense_output=False, stats=None):
+        """
+        :param backend: 'torchdiffeq' solves by torchdiffeq, 'fixed' unrolls a fixed-step method (euler, midpoint
+                        or rk4) over the prediction grid directly
+        :param adjoint: whether to save memory in the backward pass, by the adjoint method of torchdiffeq or by
+                        recomputing each step of the fixed backend
+        :param dense_output: whether to keep the interpolant of the last solve in `solution`
+        :param stats: the counters and timers of the solves, shared with the ODE function
+        """
         super(DiffeqSolver, self).__init__()
+        if backend not in ['torchdiffeq', 'fixed']:
+            raise ValueError("ODE backend {} not supported".format(backend))
+        if backend == 'fixed' and method not in FIXED_STEPS:
+            raise ValueError("Method {} not supported by the fixed backend".format(method))
 
         self.ode_method = method
         self.device = device
         self.ode_func = ode_func
+        self.backend = backend
+        self.adjoint = adjoint
+        self.dense_output = dense_output
+        self.solution = None
+        self.stats = stats if stats is not None else OdeStats()
+        if self.stats.enabled and backend == 'torchdiffeq' and method in ADAPTIVE_METHODS:
+            # count the steps by the callbacks of torchdiffeq, only registered here since the fixed-step methods
+            # warn about them
+            for phase, suffix in [('forward', ''), ('backward', '_adjoint')]:
+                setattr(ode_func, f'callback_accept_step{suffix}', self.stats.step_callback(f'{phase}_accepted'))
+                setattr(ode_func, f'callback_reject_step{suffix}', self.stats.step_callback(f'{phase}_rejected'))
 
         self.odeint_rtol = odeint_rtol
         self.odeint_atol = odeint_atol
 
+    def solve_fixed(self, first_point, time_steps_to_predict):
+        """
+        Unroll the fixed-step method over the grid, one step between two consecutive time points
+        :return: the states at the time points, tensor of shape (t, K*N, D)
+        """
+        step = FIXED_STEPS[self.ode_method]
+        pred_y = first_point.new_empty((len(time_steps_to_predict), *first_point.shape))
+        pred_y[0] = first_point
+        y = first_point
+        for i in range(len(time_steps_to_predict) - 1):
+            t0, dt = time_steps_to_predict[i], time_steps_to_predict[i + 1] - time_steps_to_predict[i]
+            # the first step runs without recomputation, since the dynamics may set up their state (e.g. the
+            # external memory) in their first evaluation
+            if self.adjoint and torch.is_grad_enabled() and i > 0:
+                y = checkpoint(step, self.ode_func, t0, dt, y, use_reentrant=False)
+            else:
+                y = step(self.ode_func, t0, dt, y)
+            pred_y[i + 1] = y
+        return pred_y
+
+    def get_dense_output(self, pred_y, time_steps_to_predict) -> DenseOutput:
+        """
+        Build the interpolant of a solution, the derivatives at the time points are evaluated by one batched call
+        of the dynamics without dropout, except for euler whose steps are linear in time
+        """
+        with torch.no_grad():
+            pred_y = pred_y.detach()
+            if self.ode_method == 'euler':
+                return DenseOutput(time_steps_to_predict, pred_y)
+            training = self.ode_func.training
+            self.ode_func.eval()
+            dy = self.ode_func(time_steps_to_predict[0], pred_y.reshape(-1, pred_y.shape[-1])).reshape(pred_y.shape)
+            self.ode_func.train(training)
+            return DenseOutput(time_steps_to_predict, pred_y, dy)
+
     def forward(self, first_point, time_steps_to_predict):
+        if self.stats.enabled:
+            self.stats.count('solves')
+            with self.stats.forward_solve():
+                if self.stats.timing:
+                    with self.stats.timer('solve'):
+                        return self.solve(first_point, time_steps_to_predict)
+                return self.solve(first_point, time_steps_to_predict)
+        return self.solve(first_point, time_steps_to_predict)
+
+    def solve(self, first_point, time_steps_to_predict):
         '''
 
         :param first_point:  [K*N,D]
@@ -27,19 +146,53 @@ class DiffeqSolver(nn.Module):
         :return:
         '''
 
-        pred_y = odeint(self.ode_func, first_point, time_steps_to_predict,
-                        rtol=self.odeint_rtol, atol=self.odeint_atol,
-                        method=self.ode_method)
+        if self.backend == 'fixed':
+            pred_y = self.solve_fixed(first_point, time_steps_to_predict)
+        else:
+            solve = odeint_adjoint if self.adjoint else odeint
+            pred_y = solve(self.ode_func, first_point, time_steps_to_predict,
+                           rtol=self.odeint_rtol, atol=self.odeint_atol,
+                           method=self.ode_method)
+        if self.dense_output:
+            self.solution = self.get_dense_output(pred_y, time_steps_to_predict)
         pred_y = pred_y.permute(1, 0, 2)
 
         return pred_y
 
 
+def euler_step(func, t0, dt, y0):
+    return y0 + dt * func(t0, y0)
+
+
+def midpoint_step(func, t0, dt, y0):
+    half_dt = 0.5 * dt
+    return y0 + dt * func(t0 + half_dt, y0 + half_dt * func(t0, y0))
+
+
+def rk4_step(func, t0, dt, y0):
+    """the 3/8 rule of the fourth order Runge-Kutta method, the same as the rk4 method of torchdiffeq"""
+    k1 = func(t0, y0)
+    k2 = func(t0 + dt / 3, y0 + dt * k1 / 3)
+    k3 = func(t0 + dt * 2 / 3, y0 + dt * (k2 - k1 / 3))
+    k4 = func(t0 + dt, y0 + dt * (k1 - k2 + k3))
+    return y0 + dt * (k1 + 3 * (k2 + k3) + k4) / 8
+
+
+FIXED_STEPS = {'euler': euler_step, 'midpoint': midpoint_step, 'rk4': rk4_step}
+# the methods of torchdiffeq that accept or reject steps
+ADAPTIVE_METHODS = ['dopri8', 'dopri5', 'bosh3', 'fehlberg2', 'adaptive_heun']
+
+
 class CasODEFunc(nn.Module):
-    def __init__(self, input_dim, output_dim, device, external_memory,params, dropout=0.2):
+    def __init__(self, input_dim, output_dim, device, external_memory,params, dropout=0.2, compile_mode='none',
+                 validator=None, stats=None):
         """
         input_dim: dimensionality of the input
         latent_dim: dimensionality used for ODE. Analog of a continous latent state
+        compile_mode: 'none' evaluates the dynamics through the submodules, 'fused' evaluates them as one function
+                      of functional ops, 'compile' compiles that function by torch.compile and falls back to 'fused'
+                      when compiling fails
+        stats: the counters and timers of the evaluations
         """
         super(CasODEFunc, self).__init__()
 
@@ -49,6 +202,40 @@ class CasODEFunc(nn.Module):
                                                      external_memory=external_memory, hidden_dim=input_dim)
         self.dropout = nn.Dropout(dropout)
         self.params=params
+        self.validator = validator if validator is not None else Validator('off')
+        self.stats = stats if stats is not None else OdeStats()
+        if compile_mode not in ['none', 'fused', 'compile']:
+            raise ValueError("Compile mode {} not supported".format(compile_mode))
+        self.compiled_dynamics = None
+        if compile_mode == 'fused' or (compile_mode == 'compile' and not hasattr(torch, 'compile')):
+            self.compiled_dynamics = self.dynamics
+        elif compile_mode == 'compile':
+            self.compiled_dynamics = torch.compile(self.dynamics)
+
+    def dynamics(self, z, keys, values):
+        """the dynamics without python state, the memory enters as its projected keys and values"""
+        if self.params['self_evolution']:
+            return self.cas_self.fused_forward(z)
+        return self.cas_external_memory.evolve_projected(z, keys, values)
+
+    def compiled_forward(self, z):
+        external_memory = self.cas_external_memory.external_memory
+        if self.params['self_evolution']:
+            keys, values = None, None
+        elif not external_memory.initialized or external_memory.attention != 'dense':
+            # the initialization of the memory and the chunked topk search stay in eager mode
+            return self.cas_external_memory(z)
+        else:
+            keys, values = external_memory.project_memory()
+        try:
+            return self.compiled_dynamics(z, keys, values)
+        except CompileError as e:
+            # errors of the dynamics themselves are raised by eager mode too and are not caught
+            if self.compiled_dynamics == self.dynamics:
+                raise
+            logging.getLogger().warning(f'failed to compile the ODE dynamics, fall back to eager mode: {e}')
+            self.compiled_dynamics = self.dynamics
+            return self.dynamics(z, keys, values)
 
     def forward(self, t_local, z, backwards=False):
         """
@@ -57,10 +244,34 @@ class CasODEFunc(nn.Module):
         t_local: current time point
         z:  [H,E] concat by axis0. H is [K*N,D], E is[K*N*N,D], z is [K*N + K*N*N, D]
         """
-        assert (not torch.isnan(z).any())
+        if self.validator.enabled:
+            self.validator.check_nan('ode function', z)
+        if self.stats.enabled:
+            self.stats.count_nfe(z.size(0))
+            if self.stats.timing:
+                with self.stats.timer('nfe'):
+                    return self.timed_forward(z)
+        return self.evaluate(z)
+
+    def evaluate(self, z):
+        if self.compiled_dynamics is not None:
+            return self.compiled_forward(z)
         if self.params['self_evolution']:
             grad_dy = self.cas_self(z)
         else:
             grad_dy = self.cas_external_memory(z)
         #
         return grad_dy
+
+    def timed_forward(self, z):
+        """evaluate with the time split into the memory attention and the MLP, the fused and compiled dynamics
+        can not be split and are timed as a whole"""
+        if self.params['self_evolution']:
+            with self.stats.timer('mlp'):
+                return self.evaluate(z)
+        if self.compiled_dynamics is not None:
+            return self.evaluate(z)
+        with self.stats.timer('attention'):
+            external_memory_repr = self.cas_external_memory.external_memory(z)
+        with self.stats.timer('mlp'):
+            return self.cas_external_memory.mix(z, external_memory_repr)
@@ -4,61 +4,138 @@ import torch.nn as nn
 
 
 class ExternalMemory(nn.Module):
-    def __init__(self, cascade_dim, device, memory_size=50, attn_dim=128):
+    def __init__(self, cascade_dim, device, memory_size=50, attn_dim=128, attention='dense', topk=32,
+                 chunk_size=4096):
+        """
+        :param attention: 'dense' attends over every slot, 'topk' attends over the topk slots with the largest
+                          scores only, which are searched chunk by chunk
+        :param topk: the number of slots attended by each query in the 'topk' attention
+        :param chunk_size: the number of slots scored at once when searching the topk slots
+        """
         super(ExternalMemory, self).__init__()
+        if attention not in ['dense', 'topk']:
+            raise ValueError("Attention {} not supported".format(attention))
         self.device = device
+        self.attention = attention
+        self.topk = topk
+        self.chunk_size = chunk_size
+        # the memory is a ring buffer, mem_ptr is the number of valid slots and write_ptr is the next slot to write
         self.mem_ptr = 0
+        self.write_ptr = 0
         self.memory_size = memory_size
         self.cascade_dim = cascade_dim
         self.attn_dim = attn_dim
 
-        self.memory = None
+        self.register_buffer('memory', torch.zeros(memory_size, cascade_dim, device=device), persistent=False)
+        self.initialized = False
+        # the projected keys and values of the memory, which are reused by all function evaluations of a solve
+        self.projection = None
 
         self.query_proj = nn.Linear(cascade_dim, attn_dim)
         self.key_proj = nn.Linear(cascade_dim, attn_dim)
         self.value_proj = nn.Linear(cascade_dim, cascade_dim)
 
     def initialize_memory(self, cascade_repr):
-
-        self.memory = torch.zeros(self.memory_size, self.cascade_dim).to(self.device)
-        batch_size = cascade_repr.size(0)
-
-        cascade_repr_detached = cascade_repr.detach()
-        self.memory[self.mem_ptr:self.mem_ptr + batch_size] = cascade_repr_detached
-        self.mem_ptr += batch_size
+        self.update_memory(cascade_repr)
+        self.initialized = True
+        self.project_memory()
+
+    def invalidate(self):
+        """drop the projected keys and values, called whenever the memory or the projections change"""
+        self.projection = None
+
+    def prepare(self):
+        """
+        Project the memory for a new solve before its first function evaluation. The memory may have changed since
+        the last solve, and a graph through the projections does not survive a backward pass. Projecting up front
+        also keeps the state of the memory fixed inside the steps of a solve, which the recomputation of
+        checkpointed steps relies on
+        """
+        self.invalidate()
+        if self.initialized:
+            self.project_memory()
+
+    def project_memory(self):
+        """
+        Project the memory into keys and values, which are cached until `invalidate` is called by a write to the
+        memory, a reset, a new solve or an update of the projections by the optimizer. The cache is also refreshed
+        when the gradient mode changes (the adjoint method solves forward without gradients and evaluates the
+        function with gradients backward)
+        :return: a tuple of (keys, values), tensors of shape (mem_ptr, attn_dim) and (mem_ptr, cascade_dim)
+        """
+        grad_enabled = torch.is_grad_enabled()
+        if self.projection is None or self.projection[0] != grad_enabled:
+            memory = self.memory[:self.mem_ptr]
+            if torch.is_grad_enabled():
+                # the projections save their input for the backward pass, keep a copy since the memory is written
+                # in place
+                memory = memory.clone()
+            self.projection = (grad_enabled, self.key_proj(memory), self.value_proj(memory))
+        return self.projection[1], self.projection[2]
+
+    def search_topk(self, query, keys):
+        """
+        Find the slots with the largest scores for each query by scanning the keys chunk by chunk, so that the
+        full (batch, mem_ptr) score matrix is never materialized
+        :param query: the projected queries, tensor of shape (batch, attn_dim)
+        :param keys: the projected keys of the memory, tensor of shape (mem_ptr, attn_dim)
+        :return: the indices of the topk slots of each query, tensor of shape (batch, topk)
+        """
+        with torch.no_grad():
+            best_scores, best_idx = None, None
+            for start in range(0, keys.size(0), self.chunk_size):
+                scores = torch.matmul(query, keys[start:start + self.chunk_size].transpose(0, 1))
+                idx = torch.arange(start, start + scores.size(1), device=scores.device).expand_as(scores)
+                if best_scores is not None:
+                    scores, idx = torch.cat([best_scores, scores], dim=1), torch.cat([best_idx, idx], dim=1)
+                best_scores, pos = torch.topk(scores, min(self.topk, scores.size(1)), dim=1)
+                best_idx = torch.gather(idx, 1, pos)
+        return best_idx
+
+    def attend_topk(self, query, keys, values):
+        """softmax attention over the topk slots of each query, the scores are recomputed for the selected slots
+        so that gradients flow into the queries, keys and values"""
+        idx = self.search_topk(query, keys)  # (batch, topk)
+        attn_weights = torch.sum(query.unsqueeze(dim=1) * keys[idx], dim=-1)  # (batch, topk)
+        attn_weights = torch.softmax(attn_weights, dim=-1)
+        return torch.sum(attn_weights.unsqueeze(dim=-1) * values[idx], dim=1)  # (batch, cascade_dim)
 
     def attend(self, cascade_repr):
+        keys, values = self.project_memory()  # (mem_ptr, attn_dim), (mem_ptr, cascade_dim)
+        return self.attend_projected(cascade_repr, keys, values)
 
+    def attend_projected(self, cascade_repr, keys, values):
+        """attend over the memory given its projected keys and values, which holds no python state"""
         query = self.query_proj(cascade_repr)  # (batch, 1, attn_dim)
-        keys = self.key_proj(self.memory[:self.mem_ptr])  # (mem_ptr, attn_dim)
+        if self.attention == 'topk' and keys.size(0) > self.topk:
+            return self.attend_topk(query, keys, values)
         attn_weights = torch.matmul(query, keys.transpose(0, 1))  # (batch, 1, mem_ptr)
         attn_weights = torch.softmax(attn_weights, dim=-1)  # (batch, 1, mem_ptr)
 
-        values = self.value_proj(self.memory[:self.mem_ptr])  # (mem_ptr, cascade_dim)
         attended_repr = torch.matmul(attn_weights, values)  # (batch, cascade_dim)
 
         return attended_repr
 
     def update_memory(self, cascade_repr):
-        batch_size = cascade_repr.size(0)
+        # only the last memory_size representations survive a batch larger than the memory
+        cascade_repr_detached = cascade_repr.detach()[-self.memory_size:]
+        batch_size = cascade_repr_detached.size(0)
 
-        cascade_repr_detached = cascade_repr.detach()
-
-        if self.mem_ptr + batch_size <= self.memory_size:
-            self.memory[self.mem_ptr:self.mem_ptr + batch_size] = cascade_repr_detached
-            self.mem_ptr += batch_size
-        else:
-            self.memory = torch.cat([self.memory[self.mem_ptr + batch_size - self.memory_size:], cascade_repr_detached],
-                                    dim=0)
-            self.mem_ptr = self.memory_size
+        slots = (self.write_ptr + torch.arange(batch_size, device=self.memory.device)) % self.memory_size
+        self.memory[slots] = cascade_repr_detached
+        self.write_ptr = (self.write_ptr + batch_size) % self.memory_size
+        self.mem_ptr = min(self.mem_ptr + batch_size, self.memory_size)
+        self.invalidate()
 
     def reset_memory(self):
-
-        self.memory = None
+        # keep the allocation of the memory for the next epoch
+        self.initialized = False
         self.mem_ptr = 0
+        self.write_ptr = 0
+        self.invalidate()
 
     def forward(self, cascade_repr):
-        if self.memory is None:
+        if not self.initialized:
             self.initialize_memory(cascade_repr)
             return cascade_repr
         else:
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from model.decoder.memory import ExternalMemory
 
 
@@ -21,6 +22,12 @@ class CasSelf(nn.Module):
         # Define the forward pass
         return x
 
+    def fused_forward(self, x):
+        """the same as forward, calling the functional ops directly instead of the submodules"""
+        hidden = F.relu(F.linear(x, self.evolve[0].weight, self.evolve[0].bias))
+        x = x + F.linear(hidden, self.evolve[2].weight, self.evolve[2].bias)
+        return F.dropout(x, self.dropout.p, self.training)
+
 
 class CasExternalMemory(nn.Module):
     def __init__(self, in_features, out_features, external_memory: ExternalMemory, hidden_dim=64, num_layers=2,
@@ -46,9 +53,24 @@ class CasExternalMemory(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
 
     def forward(self, x):
-        external_memory_repr = self.external_memory(x)
+        return self.mix(x, self.external_memory(x))
+
+    def mix(self, x, external_memory_repr):
+        """combine the states with their representations read from the external memory"""
         x = torch.cat([x, external_memory_repr], dim=1)
         x=self.lin(x)
         x=self.dropout(x)
 
         return x
+
+    def evolve_projected(self, x, keys, values):
+        """
+        The same as forward on an initialized memory with dense attention, given the projected keys and values of
+        the memory, calling the functional ops directly instead of the submodules
+        """
+        external_memory = self.external_memory
+        query = F.linear(x, external_memory.query_proj.weight, external_memory.query_proj.bias)
+        attn_weights = torch.softmax(torch.matmul(query, keys.transpose(0, 1)), dim=-1)
+        x = torch.cat([x, torch.matmul(attn_weights, values)], dim=1)
+        x = F.linear(x, self.lin.weight, self.lin.bias)
+        return F.dropout(x, self.dropout.p, self.training)
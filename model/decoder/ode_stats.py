@@ -0,0 +1,86 @@
+import time
+import torch
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+
+class OdeStats:
+    """
+    Counters and timers of the ODE decoder. The function evaluations (NFE) and the states evaluated in them are
+    counted separately for the forward solves and for the backward pass (the adjoint solves, or the recomputed
+    steps of the fixed backend), together with the accepted and rejected steps of the adaptive solvers. The time
+    of the evaluations is split into the memory attention and the MLP. When disabled the callers skip all of the
+    bookkeeping.
+    """
+
+    def __init__(self, enabled: bool = False, device: torch.device = torch.device('cpu'), timing: bool = None):
+        """
+        :param enabled: whether to count the evaluations and steps
+        :param timing: whether to time the solves and evaluations as well, which synchronizes GPUs, the same as
+                       `enabled` by default
+        """
+        self.enabled = enabled
+        self.timing = enabled if timing is None else enabled and timing
+        # the kernels run asynchronously on GPUs, so the timers wait for them
+        self.synchronize = self.timing and torch.device(device).type == 'cuda'
+        self.device = device
+        self.in_forward = False
+        self.reset()
+
+    def reset(self):
+        self.counts = {'solves': 0, 'forward_nfe': 0, 'backward_nfe': 0, 'forward_rows': 0, 'backward_rows': 0,
+                       'forward_accepted': 0, 'forward_rejected': 0, 'backward_accepted': 0, 'backward_rejected': 0}
+        self.times = {'solve': 0., 'nfe': 0., 'attention': 0., 'mlp': 0.}
+
+    def count(self, name: str, n: int = 1):
+        self.counts[name] += n
+
+    def count_nfe(self, rows: int):
+        """count an evaluation of `rows` states, which is its cost when the batches have different sizes"""
+        phase = 'forward' if self.in_forward else 'backward'
+        self.counts[f'{phase}_nfe'] += 1
+        self.counts[f'{phase}_rows'] += rows
+
+    def step_callback(self, name: str) -> Callable:
+        """a torchdiffeq step callback that counts the steps in `name`"""
+
+        def callback(t0, y0, dt):
+            self.counts[name] += 1
+
+        return callback
+
+    @contextmanager
+    def forward_solve(self):
+        """the evaluations inside this context are counted for the forward pass, the others for the backward pass"""
+        in_forward = self.in_forward
+        self.in_forward = True
+        try:
+            yield
+        finally:
+            self.in_forward = in_forward
+
+    @contextmanager
+    def timer(self, name: str):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+            self.times[name] += time.perf_counter() - start
+
+    def summary(self) -> Dict[str, float]:
+        nfe = self.counts['forward_nfe'] + self.counts['backward_nfe']
+        result = dict(self.counts)
+        result['nfe_per_solve'] = self.counts['forward_nfe'] / max(self.counts['solves'], 1)
+        if self.timing:
+            result['ms_per_nfe'] = self.times['nfe'] * 1000 / max(nfe, 1)
+            for name, cost in self.times.items():
+                result[f'{name}_time'] = cost
+        return result
+
+    def format(self) -> str:
+        return ' '.join(f'{name}:{value:.4g}' if isinstance(value, float) else f'{name}:{value}'
+                        for name, value in self.summary().items())
@@ -3,23 +3,22 @@ import torch
 from torch import nn
 from typing import Dict, Mapping, List, Union, Tuple
 from model.encoder.state.dynamic_state import DynamicState
-from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence
+from torch.nn.utils.rnn import PackedSequence
 from model.time_encoder import TimeSlotEncoder
 import torch.nn.modules.module
-from utils.hgraph import HGraph
-import dgl
+from utils.cas_history import CasHistory
 
 
 
 class EmbeddingModule(nn.Module):
     def __init__(self, dynamic_state: Mapping[str, DynamicState], embedding_dimension: int, device: torch.device,
-                 dropout: float, hgraph: HGraph):
+                 dropout: float, history: CasHistory):
         super(EmbeddingModule, self).__init__()
         self.dynamic_state = dynamic_state
         self.dropout = dropout
         self.embedding_dimension = embedding_dimension
         self.device = device
-        self.hgraph = hgraph
+        self.history = history
 
     def compute_embedding(self, cascades: np.ndarray) -> \
             Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
@@ -30,6 +29,14 @@ class EmbeddingModule(nn.Module):
         """
         ...
 
+    def reset_state(self):
+        """clear the states kept across batches, called at the beginning of every epoch"""
+        pass
+
+    def advance(self, cascades: np.ndarray):
+        """fold the events just inserted into the history of cascades into the states kept across batches"""
+        pass
+
 
 class IdentityEmbedding(EmbeddingModule):
     def compute_embedding(self, cascade):
@@ -40,37 +47,54 @@ class IdentityEmbedding(EmbeddingModule):
 
 class ConcatEmbedding(EmbeddingModule):
     def __init__(self, dynamic_state: Mapping[str, DynamicState], embedding_dimension: int, device: torch.device,
-                 dropout: float, hgraph: HGraph, max_global_time: float = 0.0, global_time_num: int = 0):
+                 dropout: float, history: CasHistory, max_global_time: float = 0.0, global_time_num: int = 0):
         super(ConcatEmbedding, self).__init__(dynamic_state, embedding_dimension, device,
-                                              dropout, hgraph)
+                                              dropout, history)
         self.time_embedding = TimeSlotEncoder(embedding_dimension, max_global_time, global_time_num)
 
     def compute_embedding(self, cascades):
-        """concat the dynamic states of the sending user, receiving user and cascade in the last interaction"""
-        cas_interaction = self.hgraph.batch_cas_info()
-        cas_pub_times = torch.tensor(self.hgraph.get_cas_pub_time(cascades), dtype=torch.float, device=self.device)
-        src_embs, dst_embs = [], []
-        for cas in cascades:
-            src, dst = zip(*cas_interaction[cas])
-            src_emb = self.dynamic_state['user'].get_state(src, 'src', from_cache=True).squeeze(dim=0)
-            dst_emb = self.dynamic_state['user'].get_state(dst, 'dst', from_cache=True).squeeze(dim=0)
-            if len(src) > 1:
-                src_emb = src_emb[-1]  # 源用户大于1，那么就是最后一个的动态
-                dst_emb = dst_emb[-1]
-            src_embs.append(src_emb)
-            dst_embs.append(dst_emb)
+        """the dynamic states of cascades in the last interaction plus the embedding of their publication time"""
+        cas_pub_times = self.history.get_cas_pub_time(cascades)
         cas_embs = self.dynamic_state['cas'].get_state(cascades, from_cache=True)
         cas_embs += self.time_embedding(cas_pub_times)
         return torch.cat([cas_embs], dim=1)
 
 
 
+class TemporalStateCache:
+    """
+    Keep the hidden state of a recurrent aggregator for every cascade together with the number of events that have
+    been folded into it, so that the aggregator only needs to consume the new events of a cascade
+    """
+
+    def __init__(self, n_cas: int, hidden_dimension: int, device: torch.device):
+        self.h = torch.zeros((n_cas, hidden_dimension), device=device)
+        self.c = torch.zeros((n_cas, hidden_dimension), device=device)
+        self.position = torch.zeros(n_cas, dtype=torch.long, device=device)
+
+    def get(self, cascades: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return self.h[cascades], self.c[cascades], self.position[cascades]
+
+    def set(self, cascades: torch.Tensor, h: torch.Tensor, c: torch.Tensor, position: torch.Tensor):
+        self.h[cascades] = h.detach()
+        self.c[cascades] = c.detach()
+        self.position[cascades] = position
+
+    def reset(self):
+        self.h.zero_()
+        self.c.zero_()
+        self.position.zero_()
+
+
 class AggregateEmbedding(EmbeddingModule):
     def __init__(self, dynamic_state: Mapping[str, DynamicState], input_dimension: int, embedding_dimension: int,
-                 device: torch.device, dropout: float, hgraph: HGraph, max_time: float, time_num: int,
+                 device: torch.device, dropout: float, history: CasHistory, max_time: float, time_num: int,
                  use_static: bool, user_num: int, max_global_time: float, global_time_num: int, use_dynamic: bool,
-                 use_temporal: bool, use_structural: bool):
-        super(AggregateEmbedding, self).__init__(dynamic_state, embedding_dimension, device, dropout, hgraph)
+                 use_temporal: bool, use_structural: bool, cas_num: int = -1, temporal_mode: str = 'full',
+                 temporal_chunk: int = 20):
+        super(AggregateEmbedding, self).__init__(dynamic_state, embedding_dimension, device, dropout, history)
+        if temporal_mode not in ['full', 'truncated', 'incremental']:
+            raise ValueError("Temporal mode {} not supported".format(temporal_mode))
         self.use_dynamic = use_dynamic
         self.use_temporal = use_temporal
         self.use_structural = use_structural
@@ -78,15 +102,25 @@ class AggregateEmbedding(EmbeddingModule):
         self.dropout = nn.Dropout(dropout)
         self.time_position_encoder = TimeSlotEncoder(embedding_dimension, max_time, time_num)
         self.position_embedding = nn.Embedding(100, embedding_dimension)
+        # 'full' runs the aggregators over the whole history of a cascade. The other modes fold the events of a
+        # cascade into a cached state as they arrive, up to the last multiple of temporal_chunk events for
+        # 'truncated', and up to the last event for 'incremental' out of training. A target feeds only the events
+        # after the cached state, in training with gradients from the detached cached state, so both modes
+        # backpropagate through at most temporal_chunk events
+        self.temporal_mode = temporal_mode
+        self.temporal_chunk = temporal_chunk
+        self.temporal_cache = {}
         if self.use_dynamic:
 
             dynamic_trans_input_dim =  input_dimension
-            self.concat_emb = ConcatEmbedding(dynamic_state, embedding_dimension, device, dropout, hgraph,
+            self.concat_emb = ConcatEmbedding(dynamic_state, embedding_dimension, device, dropout, history,
                                               max_global_time, global_time_num)  # 动态embedding
             if use_temporal:
                 dynamic_trans_input_dim += input_dimension
                 self.temporal_aggregator = nn.LSTM(input_size=input_dimension, hidden_size=embedding_dimension,
                                                    batch_first=True)
+                if temporal_mode != 'full':
+                    self.temporal_cache['dynamic'] = TemporalStateCache(cas_num, embedding_dimension, device)
             self.trans = nn.Sequential(nn.Linear(in_features=dynamic_trans_input_dim, out_features=embedding_dimension),
                                        nn.ReLU())
         if self.use_static:
@@ -95,35 +129,132 @@ class AggregateEmbedding(EmbeddingModule):
             nn.init.uniform_(self.static_state.weight, 0, 1)
             if use_temporal:
                 self.static_rnn = nn.LSTM(input_size=input_dimension, hidden_size=embedding_dimension, batch_first=True)
+                if temporal_mode != 'full':
+                    self.temporal_cache['static'] = TemporalStateCache(cas_num, embedding_dimension, device)
                 static_trans_input_dim += input_dimension
             self.static_trans = nn.Sequential(
                 nn.Linear(in_features=static_trans_input_dim, out_features=embedding_dimension),
                 nn.ReLU())
 
-    def compute_static_emb(self, cascades: np.ndarray, cas_history: torch.Tensor, length: List[int],
-                           cas_time_emb: torch.Tensor, cas_pos_emb: torch.Tensor, graph_root: dgl.DGLHeteroGraph,
-                           graph_leaf: dgl.DGLHeteroGraph) -> torch.Tensor:
+    def reset_state(self):
+        for cache in self.temporal_cache.values():
+            cache.reset()
+
+    def embed_static_user(self, users: torch.Tensor) -> torch.Tensor:
+        return self.dropout(self.static_state(users))
+
+    def embed_dynamic_user(self, users: torch.Tensor) -> torch.Tensor:
+        return self.dynamic_state['user'].get_state(users.reshape(-1), 'src', from_cache=False). \
+            reshape(*users.shape, -1)
+
+    def run_segment(self, rnn: nn.LSTM, embed_user, cas_history: torch.Tensor, cas_times: torch.Tensor,
+                    start: torch.Tensor, end: torch.Tensor, h: torch.Tensor, c: torch.Tensor) -> \
+            Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Feed the events [start, end) of each cascade into a recurrent aggregator
+        :param rnn: the recurrent aggregator
+        :param embed_user: the function that maps user ids to their representations
+        :param cas_history: the padded user sequences of cascades, tensor of shape (n_cas, max_length)
+        :param cas_times: the padded time sequences of cascades, tensor of shape (n_cas, max_length)
+        :param start: the first event to feed of each cascade, tensor of shape (n_cas)
+        :param end: the end of the events to feed of each cascade, tensor of shape (n_cas)
+        :param h: the hidden state before the start event, tensor of shape (n_cas, emb_dim)
+        :param c: the cell state before the start event, tensor of shape (n_cas, emb_dim)
+        :return: the hidden and cell states after the last fed event, cascades without new events keep their states
+        """
+        seg_length = end - start
+        active = torch.nonzero(seg_length > 0).squeeze(dim=1)
+        if len(active) == 0:
+            return h, c
+        # sort the cascades by the number of events to feed, so that the aggregator processes only the cascades
+        # that still have events at each step, and look up the representations of valid positions only
+        seg_length, order = torch.sort(seg_length[active], descending=True, stable=True)
+        active = active[order]
+        steps = torch.arange(int(seg_length[0]), device=self.device)
+        valid = steps.unsqueeze(dim=1) < seg_length.unsqueeze(dim=0)  # (max_seg_length, n_active), time-major
+        step_idx, seq_idx = torch.nonzero(valid, as_tuple=True)
+        # positions stay absolute, so a resumed segment sees the same position embeddings as a full pass
+        pos = start[active][seq_idx] + step_idx
+        cas_idx = active[seq_idx]
+        seg_emb = embed_user(cas_history[cas_idx, pos]) + self.time_position_encoder(cas_times[cas_idx, pos]) + \
+            self.position_embedding(pos)
+        seg_emb = PackedSequence(seg_emb, valid.sum(dim=1).cpu())
+        _, (seg_h, seg_c) = rnn.forward(seg_emb, (h[active].unsqueeze(dim=0), c[active].unsqueeze(dim=0)))
+        return h.index_copy(0, active, seg_h.squeeze(dim=0)), c.index_copy(0, active, seg_c.squeeze(dim=0))
+
+    def get_checkpoint(self, length: torch.Tensor) -> torch.Tensor:
+        """the number of events of each cascade folded into its cached state"""
+        if self.temporal_mode == 'incremental' and not self.training:
+            return length
+        return torch.div(length - 1, self.temporal_chunk, rounding_mode='floor').clamp(min=0) * self.temporal_chunk
+
+    def fold(self, kind: str, rnn: nn.LSTM, embed_user, cascades: np.ndarray, cas_history: torch.Tensor,
+             cas_times: torch.Tensor, length: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Bring the cached states of cascades up to their checkpoints without gradients
+        :param kind: 'dynamic' or 'static', which selects the cached states
+        :return: a tuple of (h, c, checkpoint), the states after the checkpoint events of each cascade
+        """
+        cache = self.temporal_cache[kind]
+        cas_idx = torch.from_numpy(cascades).to(self.device)
+        h, c, start = cache.get(cas_idx)
+        checkpoint = self.get_checkpoint(length)
+        # a cached state that is ahead of the checkpoint belongs to a longer history, recompute from scratch
+        stale = start > checkpoint
+        start = torch.where(stale, torch.zeros_like(start), start)
+        h, c = torch.where(stale.unsqueeze(dim=1), 0., h), torch.where(stale.unsqueeze(dim=1), 0., c)
+        with torch.no_grad():
+            h, c = self.run_segment(rnn, embed_user, cas_history, cas_times, start, checkpoint, h, c)
+        cache.set(cas_idx, h, c, checkpoint)
+        return h, c, checkpoint
+
+    def advance(self, cascades: np.ndarray):
+        """fold the new events of cascades into their cached states as they arrive, so that they are not fed again
+        when the cascades become targets"""
+        if self.temporal_mode == 'full' or not self.use_temporal:
+            return
+        cascades = np.unique(cascades)
+        cas_history, cas_times, length = self.history.read(cascades)
+        if self.use_dynamic:
+            self.fold('dynamic', self.temporal_aggregator, self.embed_dynamic_user, cascades, cas_history,
+                      cas_times, length)
+        if self.use_static:
+            self.fold('static', self.static_rnn, self.embed_static_user, cascades, cas_history, cas_times, length)
+
+    def aggregate_sequence(self, kind: str, rnn: nn.LSTM, embed_user, cascades: np.ndarray,
+                           cas_history: torch.Tensor, cas_times: torch.Tensor, length: torch.Tensor) -> torch.Tensor:
+        """
+        Aggregate the user sequences of cascades by a recurrent aggregator according to the temporal mode. The
+        cached states are kept across the batches of a pass and cleared by `reset_state`. For the dynamic
+        aggregator they fold in the user states at the time each event was consumed, while 'full' reads the
+        current user states, so the two differ once the user states have been updated. In training they also
+        fold in older parameters and pass no gradient.
+        :param kind: 'dynamic' or 'static', which selects the cached states
+        :return: the last hidden states of the aggregator, tensor of shape (n_cas, emb_dim)
+        """
+        if self.temporal_mode == 'full':
+            zeros = torch.zeros((len(cascades), self.embedding_dimension), device=self.device)
+            return self.run_segment(rnn, embed_user, cas_history, cas_times, torch.zeros_like(length), length,
+                                    zeros, zeros)[0]
+        h, c, checkpoint = self.fold(kind, rnn, embed_user, cascades, cas_history, cas_times, length)
+        return self.run_segment(rnn, embed_user, cas_history, cas_times, checkpoint, length, h, c)[0]
+
+    def compute_static_emb(self, cascades: np.ndarray, cas_history: torch.Tensor, cas_times: torch.Tensor,
+                           length: torch.Tensor) -> torch.Tensor:
         final_embedding = []
         if self.use_temporal:
-            cas_his_emb = self.dropout(self.static_state(cas_history.reshape(-1)).reshape(*cas_history.shape, -1))
-            cas_his_emb = cas_his_emb + cas_time_emb + cas_pos_emb
-            cas_his_emb = pack_padded_sequence(cas_his_emb, lengths=length, batch_first=True, enforce_sorted=False)
-            _, (h, c) = self.static_rnn.forward(cas_his_emb)
-            final_embedding.append(h.squeeze(dim=0))
+            final_embedding.append(self.aggregate_sequence('static', self.static_rnn, self.embed_static_user,
+                                                           cascades, cas_history, cas_times, length))
         return self.static_trans(torch.cat(final_embedding, dim=1))
 
-    def compute_dynamic_emb(self, cascades: np.ndarray, cas_history: torch.Tensor, length: List[int],
-                            cas_time_emb: torch.Tensor, cas_pos_emb: torch.Tensor, graph_root: dgl.DGLHeteroGraph,
-                            graph_leaf: dgl.DGLHeteroGraph) -> torch.Tensor:
+    def compute_dynamic_emb(self, cascades: np.ndarray, cas_history: torch.Tensor, cas_times: torch.Tensor,
+                            length: torch.Tensor) -> torch.Tensor:
         newest_dynamic_state = self.concat_emb.compute_embedding(cascades)
         final_embedding = [newest_dynamic_state]
         if self.use_temporal:
-            cas_his_emb = self.dynamic_state['user'].get_state(cas_history.reshape(-1), 'src', from_cache=False). \
-                reshape(*cas_history.shape, -1)
-            cas_his_emb = cas_his_emb + cas_time_emb + cas_pos_emb
-            cas_his_emb = pack_padded_sequence(cas_his_emb, lengths=length, batch_first=True, enforce_sorted=False)
-            _, (h, c) = self.temporal_aggregator.forward(cas_his_emb)
-            final_embedding.append(h.squeeze(dim=0))
+            final_embedding.append(self.aggregate_sequence('dynamic', self.temporal_aggregator,
+                                                           self.embed_dynamic_user, cascades, cas_history,
+                                                           cas_times, length))
         return self.trans(torch.cat(final_embedding, dim=1))
 
     # 计算对应id的embedding
@@ -131,22 +262,11 @@ class AggregateEmbedding(EmbeddingModule):
         """aggregate the representations of users into a cascade embedding by
         structural learning and temporal learning"""
         # concat_state
-        cas_history, cas_times, length = self.hgraph.get_cas_seq(cascades)
-        cas_history = pad_sequence(cas_history, batch_first=True).to(self.device)
-        """set all position&time emb"""
-        cas_times = pad_sequence(cas_times, batch_first=True).to(self.device)
-        cas_time_emb = self.time_position_encoder(cas_times.reshape(-1)).reshape(*cas_times.shape, -1)  # 在时间戳嵌入这个地方用到了
-        single_range = list(range(cas_times.shape[1]))
-        cas_pos = torch.tensor([single_range] * cas_times.shape[0]).to(self.device)
-        cas_pos_emb = self.position_embedding(cas_pos)
-        """set graph feature"""
-        graph_root, graph_leaf = None, None
+        cas_history, cas_times, length = self.history.read(cascades)
         if self.use_dynamic:
-            dynamic_emb = self.compute_dynamic_emb(cascades, cas_history, length, cas_time_emb, cas_pos_emb, graph_root,
-                                                   graph_leaf)
+            dynamic_emb = self.compute_dynamic_emb(cascades, cas_history, cas_times, length)
         if self.use_static:
-            static_emb = self.compute_static_emb(cascades, cas_history, length, cas_time_emb, cas_pos_emb, graph_root,
-                                                 graph_leaf)
+            static_emb = self.compute_static_emb(cascades, cas_history, cas_times, length)
         if self.use_static and self.use_dynamic:
             return (static_emb, dynamic_emb)
         elif self.use_static:
@@ -157,32 +277,34 @@ class AggregateEmbedding(EmbeddingModule):
 
 def get_embedding_module(module_type: str, dynamic_state: Mapping[str, DynamicState],
                          input_dimension: int, embedding_dimension: int, device: torch.device,
-                         dropout: float = 0.1, hgraph: HGraph = None, max_time: float = 1.0,
+                         dropout: float = 0.1, history: CasHistory = None, max_time: float = 1.0,
                          time_num: int = 20, use_static: bool = False, user_num: int = -1,
                          max_global_time: float = 100.0, global_time_num: int = 50,
                          use_dynamic: bool = True, use_temporal: bool = True,
-                         use_structural: bool = True) -> EmbeddingModule:
+                         use_structural: bool = True, cas_num: int = -1, temporal_mode: str = 'full',
+                         temporal_chunk: int = 20) -> EmbeddingModule:
     if module_type == "identity":
         return IdentityEmbedding(dynamic_state=dynamic_state,
                                  embedding_dimension=embedding_dimension,
                                  device=device,
                                  dropout=dropout,
-                                 hgraph=hgraph)
+                                 history=history)
     elif module_type == 'aggregate':
         return AggregateEmbedding(dynamic_state=dynamic_state,
                                   embedding_dimension=embedding_dimension,
                                   device=device,
                                   dropout=dropout,
-                                  hgraph=hgraph,
+                                  history=history,
                                   input_dimension=input_dimension,
                                   max_time=max_time,
                                   time_num=time_num,
                                   use_static=use_static, user_num=user_num, max_global_time=max_global_time,
                                   global_time_num=global_time_num, use_dynamic=use_dynamic, use_temporal=use_temporal,
-                                  use_structural=use_structural)
+                                  use_structural=use_structural, cas_num=cas_num, temporal_mode=temporal_mode,
+                                  temporal_chunk=temporal_chunk)
     elif module_type == 'concat':
         return ConcatEmbedding(dynamic_state=dynamic_state, embedding_dimension=embedding_dimension,
-                               device=device, dropout=dropout, hgraph=hgraph,
+                               device=device, dropout=dropout, history=history,
                                max_global_time=max_global_time,
                                global_time_num=global_time_num)
     else:
@@ -1,6 +1,5 @@
-from collections import defaultdict
 import torch
-from typing import List, Dict, Tuple
+from typing import Tuple
 import numpy as np
 
 
@@ -9,73 +8,67 @@ class MessageAggregator(torch.nn.Module):
         super(MessageAggregator, self).__init__()
         self.device = device
 
-    def aggregate(self, node_ids: List[int], messages: Dict[int, List[Tuple[torch.Tensor, torch.Tensor]]]) -> \
-            Tuple[List[int], torch.Tensor, torch.Tensor]:
+    def aggregate(self, node_ids: np.ndarray, messages: torch.Tensor, timestamps: torch.Tensor) -> \
+            Tuple[np.ndarray, torch.Tensor, torch.Tensor]:
         """
-        Given a list of node ids, and a dict of messages of nodes in the list, aggregate different
-        messages for the same id using one of the possible strategies
-        :param node_ids: a list of node ids of length batch_size
-        :param messages: a dict that stores messages for nodes, and message[i][j] is a tuple of
-                        (message_vector,timestamp) which indicate the message vector and timestamp of the
-                        `j` the interaction that node `i` occurs in
+        Given the node id of each message, aggregate different messages for the same id using one of the possible
+        strategies
+        :param node_ids: the node id of each message, ndarray of shape (batch)
+        :param messages: the message vectors, tensor of shape (batch, message_dim)
+        :param timestamps: the timestamp of each message, tensor of shape (batch)
         :return: a tuple of (to_update_node_ids,unique_messages,unique_timestamps), where
-                  to_update_node_ids  is a list of length n_unique_node_ids with the unique node ids
+                  to_update_node_ids is a sorted ndarray of shape (n_unique_node_ids) with the unique node ids
                   unique_messages is a tensor of shape (n_unique_node_ids, message_dim) with the aggregated messages
-                  unique_timestamps is a tensor of shape (n_unique_node_ids, 1) with aggregated timestamps
+                  unique_timestamps is a tensor of shape (n_unique_node_ids) with the timestamps of the last
+                  messages
         """
 
+    @staticmethod
+    def group(node_ids: np.ndarray, device: torch.device) -> Tuple[np.ndarray, torch.Tensor, torch.Tensor]:
+        """
+        :return: a tuple of (unique_node_ids, inverse, last), where inverse maps each message to its unique node id
+                 and last is the position of the last message of each unique node id
+        """
+        unique_node_ids, inverse = torch.unique(torch.as_tensor(np.asarray(node_ids)), return_inverse=True)
+        inverse = inverse.to(device)
+        positions = torch.arange(len(inverse), device=device)
+        last = positions.new_zeros(len(unique_node_ids)).scatter_reduce(0, inverse, positions, 'amax',
+                                                                        include_self=False)
+        return unique_node_ids.numpy(), inverse, last
+
 
 class LastMessageAggregator(MessageAggregator):
     def __init__(self, device: torch.device):
         super(LastMessageAggregator, self).__init__(device)
 
-    def aggregate(self, node_ids, messages):
+    def aggregate(self, node_ids, messages, timestamps):
         """Keep the last message for each node"""
-        unique_node_ids = np.unique(node_ids)
-        unique_messages = []
-        unique_timestamps = []
-
-        to_update_node_ids = []
-
-        for node_id in unique_node_ids:
-            if len(messages[node_id]) > 0:
-                to_update_node_ids.append(node_id)
-                # Last Update
-                unique_messages.append(messages[node_id][-1][0])
-                unique_timestamps.append(messages[node_id][-1][1])
-
-
-
-        unique_messages = torch.stack(unique_messages) if len(to_update_node_ids) > 0 else []
-        unique_timestamps = torch.stack(unique_timestamps) if len(to_update_node_ids) > 0 else []
-
-        return to_update_node_ids, unique_messages, unique_timestamps
+        unique_node_ids, _, last = self.group(node_ids, messages.device)
+        return unique_node_ids, messages[last], timestamps[last]
 
 
 class MeanMessageAggregator(MessageAggregator):
     def __init__(self, device: torch.device):
         super(MeanMessageAggregator, self).__init__(device)
 
-    def aggregate(self, node_ids, messages):
+    def aggregate(self, node_ids, messages, timestamps):
         """Mean all messages for each node"""
-        unique_node_ids = np.unique(node_ids)
-        unique_messages = []
-        unique_timestamps = []
+        unique_node_ids, inverse, last = self.group(node_ids, messages.device)
+        unique_messages = messages.new_zeros(len(unique_node_ids), messages.shape[1]).index_add(0, inverse, messages)
+        counts = torch.bincount(inverse, minlength=len(unique_node_ids)).to(messages.dtype)
+        return unique_node_ids, unique_messages / counts.unsqueeze(dim=1), timestamps[last]
 
-        to_update_node_ids = []
-        n_messages = 0
 
-        for node_id in unique_node_ids:
-            if len(messages[node_id]) > 0:
-                n_messages += len(messages[node_id])
-                to_update_node_ids.append(node_id)
-                unique_messages.append(torch.mean(torch.stack([m[0] for m in messages[node_id]]), dim=0))
-                unique_timestamps.append(messages[node_id][-1][1])
-
-        unique_messages = torch.stack(unique_messages) if len(to_update_node_ids) > 0 else []
-        unique_timestamps = torch.stack(unique_timestamps) if len(to_update_node_ids) > 0 else []
+class MaxMessageAggregator(MessageAggregator):
+    def __init__(self, device: torch.device):
+        super(MaxMessageAggregator, self).__init__(device)
 
-        return to_update_node_ids, unique_messages, unique_timestamps
+    def aggregate(self, node_ids, messages, timestamps):
+        """Take the element-wise maximum of all messages for each node"""
+        unique_node_ids, inverse, last = self.group(node_ids, messages.device)
+        unique_messages = messages.new_zeros(len(unique_node_ids), messages.shape[1]).scatter_reduce(
+            0, inverse.unsqueeze(dim=1).expand_as(messages), messages, 'amax', include_self=False)
+        return unique_node_ids, unique_messages, timestamps[last]
 
 
 def get_message_aggregator(aggregator_type: str, device: torch.device) -> MessageAggregator:
@@ -83,5 +76,7 @@ def get_message_aggregator(aggregator_type: str, device: torch.device) -> Messag
         return LastMessageAggregator(device=device)
     elif aggregator_type == "mean":
         return MeanMessageAggregator(device=device)
+    elif aggregator_type == "max":
+        return MaxMessageAggregator(device=device)
     else:
         raise ValueError("Message aggregator {} not implemented".format(aggregator_type))
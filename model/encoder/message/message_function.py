@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 
 
@@ -12,6 +13,17 @@ class MessageFunction(nn.Module):
         """generate message for an interaction"""
         return None
 
+    def compute_shared_message(self, raw_messages: torch.Tensor, time_embs: torch.Tensor) -> torch.Tensor:
+        """
+        generate the messages of several time embeddings that share the same raw messages
+        :param raw_messages: raw message, tensor of shape (batch,raw_message_dim)
+        :param time_embs: time embeddings of `k` groups stacked by rows, tensor of shape (k*batch,time_dim)
+        :return message: the message of [raw_messages, time_embs] of each group stacked by rows,
+                         tensor of shape (k*batch,message_dim)
+        """
+        n_groups = len(time_embs) // len(raw_messages)
+        return self.compute_message(torch.cat([raw_messages.repeat(n_groups, 1), time_embs], dim=1))
+
 
 class MLPMessageFunction(MessageFunction):
     def __init__(self, raw_message_dimension: int, message_dimension: int):
@@ -32,6 +44,14 @@ class MLPMessageFunction(MessageFunction):
         messages = self.mlp(raw_messages)
         return messages
 
+    def compute_shared_message(self, raw_messages: torch.Tensor, time_embs: torch.Tensor) -> torch.Tensor:
+        """the raw messages go through the first layer once, and only the time embeddings are projected per group"""
+        n_groups = len(time_embs) // len(raw_messages)
+        first_layer, raw_dim = self.mlp[0], raw_messages.shape[1]
+        hidden = F.linear(raw_messages, first_layer.weight[:, :raw_dim]).repeat(n_groups, 1) + \
+            F.linear(time_embs, first_layer.weight[:, raw_dim:], first_layer.bias)
+        return self.mlp[1:](hidden)
+
 
 class IdentityMessageFunction(MessageFunction):
     def compute_message(self, raw_messages: torch.Tensor) -> torch.Tensor:
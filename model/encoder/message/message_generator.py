@@ -1,7 +1,6 @@
 import numpy as np
 import torch.nn as nn
 import torch
-from collections import defaultdict
 from typing import Dict, Mapping, Tuple, List, Any
 from model.encoder.state.dynamic_state import DynamicState
 from model.encoder.message.message_function import get_message_function
@@ -41,15 +40,17 @@ class MessageGenerator(nn.Module):
 
 
 
-    def aggregate_transform(self, multi_nodes: Dict[str, List[int]],
-                            multi_messages: Dict[str, Dict[int, List[Tuple[torch.Tensor, torch.Tensor]]]]) -> \
-            Tuple[Dict[str, List[int]], Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+    def aggregate_transform(self, multi_nodes: Dict[str, np.ndarray], multi_messages: Dict[str, torch.Tensor],
+                            multi_timestamps: Dict[str, torch.Tensor]) -> \
+            Tuple[Dict[str, np.ndarray], Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
         """
         Aggregate messages for nodes
-        :param multi_nodes: a dictionary, where multi_nodes[ntype] is a list that stores all nodes that should generate
-                            a unique message in this batch
-        :param multi_messages: a dictionary, where multi_messages[ntype][i] is a list that stores all the messages
-                               of node `i` belonging to node type `ntype`
+        :param multi_nodes: a dictionary, where multi_nodes[ntype] is an ndarray that stores the node of each message
+                            of node type `ntype` in this batch
+        :param multi_messages: a dictionary, where multi_messages[ntype] is a tensor that stores the messages of node
+                               type `ntype`, one row per entry of multi_nodes[ntype]
+        :param multi_timestamps: a dictionary, where multi_timestamps[ntype] is a tensor that stores the timestamp of
+                                 each message of node type `ntype`
         :return: the unique messages of nodes, which is a tuple of node ids, generated messages,
                  timestamps of interactions
         """
@@ -57,7 +58,7 @@ class MessageGenerator(nn.Module):
         unique_multi_nodes, unique_multi_messages, unique_multi_timestamps = {}, {}, {}
         for node_type in node_types:
             unique_nodes, unique_messages, unique_timestamps = self.message_aggregator.aggregate(
-                multi_nodes[node_type], multi_messages[node_type])
+                multi_nodes[node_type], multi_messages[node_type], multi_timestamps[node_type])
             unique_multi_nodes[node_type] = unique_nodes
             unique_multi_messages[node_type] = unique_messages
             unique_multi_timestamps[node_type] = unique_timestamps
@@ -70,10 +71,22 @@ class ConCatMessage(MessageGenerator):
         super(ConCatMessage, self).__init__(state=state, time_encoder=time_encoder,
                                             device=device, message_aggregator_type=message_aggregator_type,
                                             message_function=message_function)
+        # users and cascades share the message function and the time encoder, so their messages can be computed
+        # by one batched call
+        self.single = message_function['user']['src'] is message_function['cas'] and \
+            message_function['user']['dst'] is message_function['cas'] and time_encoder['user'] is time_encoder['cas']
+
+    def get_raw_message(self, source_nodes: np.ndarray, destination_nodes: np.ndarray,
+                        trans_cascades: np.ndarray) -> torch.Tensor:
+        """concat the states of the sending user, receiving user and cascade of each interaction"""
+        return torch.cat(
+            [self.state['user'].get_state(source_nodes, 'src'),
+             self.state['user'].get_state(destination_nodes, 'dst'),
+             self.state['cas'].get_state(trans_cascades)], dim=1)
 
     def get_user_message(self, source_nodes: np.ndarray, destination_nodes: np.ndarray, trans_cascades: np.ndarray,
                          edge_times: torch.Tensor, unique_multi_nodes: Dict,
-                         unique_multi_messages: Dict, unique_multi_timestamps: Dict):
+                         unique_multi_messages: Dict, unique_multi_timestamps: Dict, raw_message: torch.Tensor = None):
         """generate messages for users
         :param source_nodes: the sending users' id, ndarray of shape (batch)
         :param destination_nodes: the receiving users' id, ndarray of shape (batch)
@@ -82,11 +95,10 @@ class ConCatMessage(MessageGenerator):
         :param unique_multi_nodes: a dict to store the node id of each unique message
         :param unique_multi_messages: a dict to store the embedding vector of each unique message
         :param unique_multi_timestamps: a dict to store the timestamp of each unique message
+        :param raw_message: the output of `get_raw_message` if it has been computed
         """
-        raw_message = torch.cat(
-            [self.state['user'].get_state(source_nodes, 'src'),
-             self.state['user'].get_state(destination_nodes, 'dst'),
-             self.state['cas'].get_state(trans_cascades)], dim=1)
+        if raw_message is None:
+            raw_message = self.get_raw_message(source_nodes, destination_nodes, trans_cascades)
         source_time_emb = self.time_encoder['user'](
             edge_times - self.state['user'].get_last_update(source_nodes))
         des_time_emb = self.time_encoder['user'](edge_times - self.state['user'].get_last_update(destination_nodes))
@@ -94,22 +106,16 @@ class ConCatMessage(MessageGenerator):
             torch.cat([raw_message, source_time_emb], dim=1))
         dst_message = self.message_function['user']['dst'].compute_message(
             torch.cat([raw_message, des_time_emb], dim=1))
-        nodes = {'src': [], 'dst': []}
-        messages = {'src': defaultdict(list), 'dst': defaultdict(list)}
-        for src_id, dst_id, src, dst, time in zip(source_nodes, destination_nodes, source_message, dst_message,
-                                                  edge_times):
-            nodes['src'].append(src_id)
-            nodes['dst'].append(dst_id)
-            messages['src'][src_id].append((src, time))
-            messages['dst'][dst_id].append((dst, time))
-        m_nodes, m_messages, m_times = self.aggregate_transform(nodes, messages)
+        m_nodes, m_messages, m_times = self.aggregate_transform({'src': source_nodes, 'dst': destination_nodes},
+                                                                {'src': source_message, 'dst': dst_message},
+                                                                {'src': edge_times, 'dst': edge_times})
         unique_multi_nodes['user'] = m_nodes
         unique_multi_messages['user'] = m_messages
         unique_multi_timestamps['user'] = m_times
 
     def get_cas_message(self, source_nodes: np.ndarray, destination_nodes: np.ndarray, trans_cascades: np.ndarray,
                         edge_times: torch.Tensor, pub_times: torch.Tensor, unique_multi_nodes: dict,
-                        unique_multi_messages: dict, unique_multi_timestamps: dict):
+                        unique_multi_messages: dict, unique_multi_timestamps: dict, raw_message: torch.Tensor = None):
         """generate messages for cascades
         :param source_nodes: the sending users' id, ndarray of shape (batch)
         :param destination_nodes: the receiving users' id, ndarray of shape (batch)
@@ -119,31 +125,52 @@ class ConCatMessage(MessageGenerator):
         :param unique_multi_nodes: a dict to store the node id of each unique message
         :param unique_multi_messages: a dict to store the embedding vector of each unique message
         :param unique_multi_timestamps: a dict to store the timestamp of each unique message
+        :param raw_message: the output of `get_raw_message` if it has been computed
         """
-        nodes = {'cas': []}
-        messages = {'cas': defaultdict(list)}
-        raw_message = torch.cat(
-            [self.state['user'].get_state(source_nodes, 'src'),
-             self.state['user'].get_state(destination_nodes, 'dst'),
-             self.state['cas'].get_state(trans_cascades)], dim=1)
+        if raw_message is None:
+            raw_message = self.get_raw_message(source_nodes, destination_nodes, trans_cascades)
         cas_time_emb = self.time_encoder['cas'](edge_times - pub_times)
         cas_message = self.message_function['cas'].compute_message(torch.cat([raw_message, cas_time_emb], dim=1))
-        for cas_id, cas, time in zip(trans_cascades, cas_message, edge_times):
-            nodes['cas'].append(cas_id)
-            messages['cas'][cas_id].append((cas, time))
-        m_nodes, m_messages, m_times = self.aggregate_transform(nodes, messages)
+        m_nodes, m_messages, m_times = self.aggregate_transform({'cas': trans_cascades}, {'cas': cas_message},
+                                                                {'cas': edge_times})
         unique_multi_nodes.update(m_nodes)
         unique_multi_messages.update(m_messages)
         unique_multi_timestamps.update(m_times)
 
+    def get_single_message(self, source_nodes: np.ndarray, destination_nodes: np.ndarray, trans_cascades: np.ndarray,
+                           edge_times: torch.Tensor, pub_times: torch.Tensor, unique_multi_nodes: dict,
+                           unique_multi_messages: dict, unique_multi_timestamps: dict, raw_message: torch.Tensor):
+        """generate messages for users and cascades at once when they share the message function and time encoder,
+        the parameters are the same as `get_cas_message`"""
+        time_emb = self.time_encoder['cas'](torch.cat([edge_times - self.state['user'].get_last_update(source_nodes),
+                                                       edge_times - self.state['user'].get_last_update(
+                                                           destination_nodes),
+                                                       edge_times - pub_times]))
+        source_message, dst_message, cas_message = torch.split(
+            self.message_function['cas'].compute_shared_message(raw_message, time_emb), len(edge_times))
+        m_nodes, m_messages, m_times = self.aggregate_transform(
+            {'src': source_nodes, 'dst': destination_nodes, 'cas': trans_cascades},
+            {'src': source_message, 'dst': dst_message, 'cas': cas_message},
+            {'src': edge_times, 'dst': edge_times, 'cas': edge_times})
+        for ntypes, unique_multi in [(m_nodes, unique_multi_nodes), (m_messages, unique_multi_messages),
+                                     (m_times, unique_multi_timestamps)]:
+            unique_multi['user'] = {'src': ntypes['src'], 'dst': ntypes['dst']}
+            unique_multi['cas'] = ntypes['cas']
+
     def get_message(self, source_nodes, destination_nodes, trans_cascades, edge_times, pub_times, target):
         unique_multi_nodes, unique_multi_messages, unique_multi_timestamps = dict(), dict(), dict()
+        # the states of the interactions are the same for the messages of users and cascades
+        raw_message = self.get_raw_message(source_nodes, destination_nodes, trans_cascades)
+        if target == 'all' and self.single:
+            self.get_single_message(source_nodes, destination_nodes, trans_cascades, edge_times, pub_times,
+                                    unique_multi_nodes, unique_multi_messages, unique_multi_timestamps, raw_message)
+            return unique_multi_nodes, unique_multi_messages, unique_multi_timestamps
         if target == 'user' or target == 'all':
             self.get_user_message(source_nodes, destination_nodes, trans_cascades, edge_times, unique_multi_nodes,
-                                  unique_multi_messages, unique_multi_timestamps)
+                                  unique_multi_messages, unique_multi_timestamps, raw_message)
         if target == 'cas' or target == 'all':
             self.get_cas_message(source_nodes, destination_nodes, trans_cascades, edge_times, pub_times,
-                                 unique_multi_nodes, unique_multi_messages, unique_multi_timestamps)
+                                 unique_multi_nodes, unique_multi_messages, unique_multi_timestamps, raw_message)
         return unique_multi_nodes, unique_multi_messages, unique_multi_timestamps
 
 
@@ -2,13 +2,15 @@ import torch
 from torch import nn
 import numpy as np
 from typing import Sequence
+from utils.validation import Validator
 
 
 
 class DynamicState(nn.Module):
     def __init__(self, n_nodes: int, state_dimension: int, input_dimension: int, message_dimension: int = None,
-                 device: torch.device = None, single: bool = False):
+                 device: torch.device = None, single: bool = False, validator: Validator = None):
         super(DynamicState, self).__init__()
+        self.validator = validator if validator is not None else Validator('off')
         self.n_nodes = n_nodes
         self.state_dimension = state_dimension
         self.input_dimension = input_dimension
@@ -19,32 +21,52 @@ class DynamicState(nn.Module):
 
     def __init_state__(self):
         self.state = nn.ParameterDict().to(self.device)
-        # cache is used to store the updated states in each batch
+        # cache is used to store the updated states in each batch, and cache_slot maps a node id to the row of its
+        # state in the cache, or -1 if the node is not cached
         self.cache = dict()
+        self.cache_slot = dict()
         state_dim = self.state_dimension
         state_src = nn.Parameter(torch.zeros((self.n_nodes, state_dim)).to(self.device),
                                  requires_grad=False)
         self.state['src'] = state_src
         self.cache['src'] = []
+        self.cache_slot['src'] = torch.full((self.n_nodes,), -1, dtype=torch.long, device=self.device)
 
         if not self.is_single:
             self.cache['dst'] = []
+            self.cache_slot['dst'] = torch.full((self.n_nodes,), -1, dtype=torch.long, device=self.device)
             self.state['dst'] = nn.Parameter(torch.zeros((self.n_nodes, state_dim)).to(self.device),
                                              requires_grad=False)
         self.last_update = nn.Parameter(torch.zeros(self.n_nodes).to(self.device),
                                         requires_grad=False)
 
+    def to_index(self, node_idxs: Sequence) -> torch.Tensor:
+        if isinstance(node_idxs, torch.Tensor):
+            return node_idxs.to(device=self.cache_slot['src'].device, dtype=torch.long)
+        return torch.as_tensor(np.asarray(node_idxs, dtype=np.int64), device=self.cache_slot['src'].device)
+
     def get_state(self, node_idxs: Sequence, type: str = 'src', from_cache: bool = False) -> torch.Tensor:
+        """
+        :param from_cache: whether to read the states updated in this batch, all the given nodes must be cached,
+                           which is checked by the validator
+        """
         if from_cache:
-            node_map, temp_idx, temp_state = self.cache[type]
-            return temp_state[list(map(lambda x: node_map[x], node_idxs))]
+            temp_idx, temp_state = self.cache[type]
+            node_idxs = self.to_index(node_idxs)
+            slot = self.cache_slot[type][node_idxs]
+            if self.validator.enabled:
+                self.validator.check_cached(f'{type} state cache', node_idxs, slot)
+            return temp_state[slot]
         else:
             return self.state[type][node_idxs, :]
 
     def set_state(self, node_idxs: Sequence, values: torch.Tensor, type: str = 'src', set_cache: bool = False):
         if set_cache:
-            node_map = dict(zip(node_idxs, np.arange(len(node_idxs))))
-            self.cache[type] = [node_map, node_idxs, values]
+            if len(self.cache[type]) > 0:
+                self.cache_slot[type][self.cache[type][0]] = -1
+            temp_idx = self.to_index(node_idxs)
+            self.cache_slot[type][temp_idx] = torch.arange(len(temp_idx), device=temp_idx.device)
+            self.cache[type] = [temp_idx, values]
         else:
             self.state[type][node_idxs, :] = values.detach()
 
@@ -66,11 +88,15 @@ class DynamicState(nn.Module):
         for u in self.state:
             self.state[u].data = self.state[u].new_zeros(self.state[u].shape)
             self.cache[u] = []
+            self.cache_slot[u].fill_(-1)
         self.last_update.data = self.last_update.new_zeros(self.last_update.shape)
 
 
     def store_cache(self):
         for ntype in self.cache:
-            _, temp_node_idx, temp_state = self.cache[ntype]
+            if len(self.cache[ntype]) == 0:
+                continue
+            temp_node_idx, temp_state = self.cache[ntype]
             self.state[ntype][temp_node_idx, :] = temp_state
+            self.cache_slot[ntype][temp_node_idx] = -1
             self.cache[ntype] = []
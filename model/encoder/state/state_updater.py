@@ -2,6 +2,7 @@ from torch import nn
 import torch
 import numpy as np
 from model.encoder.state.dynamic_state import DynamicState
+from utils.validation import Validator
 from typing import Dict, Mapping, List, Sequence, Type
 
 
@@ -22,9 +23,10 @@ class StateUpdater(nn.Module):
 class SequenceStateUpdater(StateUpdater):
     def __init__(self, state: Mapping[str, DynamicState], message_dimension: int, state_dimension: int,
                  device: torch.device, ntypes: set, updater_function: Type[nn.RNNCellBase],
-                 single_updater: bool = False):
+                 single_updater: bool = False, validator: Validator = None):
         super(SequenceStateUpdater, self).__init__()
         self.state = state
+        self.validator = validator if validator is not None else Validator('off')
         self.message_dimension = message_dimension
         self.state_dimension = state_dimension
         self.ntypes = ntypes
@@ -44,12 +46,14 @@ class SequenceStateUpdater(StateUpdater):
     def update_src_dst_user_state(self, user_nodes: Dict[str, List[int]], user_messages: Dict[str, torch.Tensor],
                                   user_timestamps: Dict[str, torch.Tensor]):
         """update the dynamic states of users"""
-        previous_timestamps = {'src': self.state['user'].get_last_update(user_nodes['src']),
-                               'dst': self.state['user'].get_last_update(user_nodes['dst'])}
+        if self.validator.enabled:
+            previous_timestamps = {'src': self.state['user'].get_last_update(user_nodes['src']),
+                                   'dst': self.state['user'].get_last_update(user_nodes['dst'])}
         for ntype in ['src', 'dst']:
             unique_node_ids = user_nodes[ntype]
             timestamps = user_timestamps[ntype]
-            self.check_illegal(unique_node_ids, previous_timestamps[ntype], timestamps, 'user')
+            if self.validator.enabled:
+                self.check_illegal(unique_node_ids, previous_timestamps[ntype], timestamps, 'user')
             last_time = self.state['user'].get_last_update(unique_node_ids)
             self.state['user'].set_last_update(unique_node_ids, torch.max(last_time, timestamps))
             state = self.state['user'].get_state(unique_node_ids, ntype)
@@ -58,7 +62,8 @@ class SequenceStateUpdater(StateUpdater):
 
     def update_cas_state(self, unique_node_ids: List[int], unique_messages: torch.Tensor, timestamps: torch.Tensor):
         """update the dynamic states of cascades"""
-        self.check_illegal(unique_node_ids, self.state['cas'].get_last_update(unique_node_ids), timestamps, 'cas')
+        if self.validator.enabled:
+            self.check_illegal(unique_node_ids, self.state['cas'].get_last_update(unique_node_ids), timestamps, 'cas')
         state = self.state['cas'].get_state(unique_node_ids)
         self.state['cas'].set_last_update(unique_node_ids, timestamps)
         updated_state = self.updaters['cas'](unique_messages, state)
@@ -67,15 +72,7 @@ class SequenceStateUpdater(StateUpdater):
     def check_illegal(self, unique_node_ids: List[int], last_update_time: torch.Tensor, timestamps: torch.Tensor,
                       ntype: str):
         """check whether violate the timing constraints"""
-        try:
-            assert (last_update_time <= timestamps).all().item(), "Trying to " \
-                                                                  "update state to time in the past"
-        except Exception as e:
-            unique_node_ids = torch.tensor(unique_node_ids)
-            ill_ids = last_update_time > timestamps
-            print(ntype, unique_node_ids[ill_ids], '\n',
-                  last_update_time[ill_ids], '\n', timestamps[ill_ids])
-            exit(0)
+        self.validator.check_time_order(f'{ntype} state update', unique_node_ids, last_update_time, timestamps)
 
     def update_state(self, unique_multi_node_ids, unique_multi_messages, unique_multi_timestamps, type='all'):
         if type == 'user' or type == 'all':
@@ -87,10 +84,11 @@ class SequenceStateUpdater(StateUpdater):
 
 
 def get_state_updater(module_type: str, state: Mapping[str, DynamicState], message_dimension: int, state_dimension: int,
-                      device: torch.device, single_updater: bool, ntypes: set) -> StateUpdater:
+                      device: torch.device, single_updater: bool, ntypes: set,
+                      validator: Validator = None) -> StateUpdater:
     if module_type == "gru":
         return SequenceStateUpdater(state, message_dimension, state_dimension, device, ntypes, nn.GRUCell,
-                                    single_updater)
+                                    single_updater, validator)
     elif module_type == "rnn":
         return SequenceStateUpdater(state, message_dimension, state_dimension, device, ntypes, nn.RNNCell,
-                                    single_updater)
+                                    single_updater, validator)
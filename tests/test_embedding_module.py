@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+import torch
+from model.encoder.embedding_module import get_embedding_module
+from utils.cas_history import CasHistory
+
+N_USER, N_CAS, DIM = 20, 6, 8
+
+
+def build(temporal_mode: str, history: CasHistory, dropout: float = 0.1):
+    torch.manual_seed(0)
+    return get_embedding_module('aggregate', dynamic_state=None, input_dimension=DIM, embedding_dimension=DIM,
+                                device=torch.device('cpu'), dropout=dropout, history=history, use_static=True,
+                                user_num=N_USER,
+                                use_dynamic=False, use_temporal=True, use_structural=False, cas_num=N_CAS,
+                                temporal_mode=temporal_mode, temporal_chunk=3)
+
+
+@pytest.mark.parametrize('temporal_mode', ['incremental', 'truncated'])
+def test_cached_modes_match_full_with_static_states(temporal_mode):
+    """the cached modes resume from the states of earlier batches and should give the embeddings of a full pass"""
+    rng = np.random.default_rng(0)
+    history = CasHistory(N_USER, N_CAS)
+    full, cached = build('full', history).eval(), build(temporal_mode, history).eval()
+    with torch.no_grad():
+        for _ in range(8):
+            cascades = rng.integers(0, N_CAS, 5)
+            users = rng.integers(0, N_USER, 5)
+            times = torch.from_numpy(rng.random(5)).float()
+            history.insert(cascades, users, times, torch.zeros(5))
+            targets = np.unique(cascades)
+            assert torch.allclose(full.compute_embedding(targets), cached.compute_embedding(targets), atol=1e-6)
+    # the states were cached and resumed from
+    assert int(cached.temporal_cache['static'].position.sum()) > 0
+
+
+def replay(module, history: CasHistory, batches, fed=None):
+    """
+    Replay batches of events in the order of the training loop: insert them, advance the cached states and embed
+    the cascades whose last event is in the batch, which are the only targets of a pass
+    :param fed: if given, the number of events fed by the targets is appended to it
+    """
+    run_segment = module.run_segment
+
+    def count(rnn, embed_user, cas_history, cas_times, start, end, h, c):
+        fed.append(int((end - start).clamp(min=0).sum()))
+        return run_segment(rnn, embed_user, cas_history, cas_times, start, end, h, c)
+
+    last = {int(cas): k for k, (cascades, _) in enumerate(batches) for cas in cascades}
+    embeddings = []
+    for k, (cascades, users) in enumerate(batches):
+        history.insert(cascades, users, torch.linspace(0., 0.9, len(cascades)), torch.zeros(len(cascades)))
+        module.advance(cascades)
+        targets = np.array(sorted(cas for cas in set(cascades.tolist()) if last[cas] == k), dtype=np.int64)
+        if len(targets) == 0:
+            continue
+        if fed is not None:
+            module.run_segment = count
+        embeddings.append(module.compute_embedding(targets))
+        module.run_segment = run_segment
+    return torch.cat(embeddings)
+
+
+def make_batches(n_batch: int = 12, batch_size: int = 6):
+    rng = np.random.default_rng(1)
+    return [(rng.integers(0, N_CAS, batch_size), rng.integers(0, N_USER, batch_size)) for _ in range(n_batch)]
+
+
+@pytest.mark.parametrize('temporal_mode', ['incremental', 'truncated'])
+def test_cached_modes_resume_in_a_pass(temporal_mode):
+    """each cascade is a target once per pass, so the states cached while its events arrive should be used"""
+    batches = make_batches()
+    full_history, history = CasHistory(N_USER, N_CAS), CasHistory(N_USER, N_CAS)
+    full, cached = build('full', full_history).eval(), build(temporal_mode, history).eval()
+    fed = []
+    with torch.no_grad():
+        expected = replay(full, full_history, batches)
+        assert torch.allclose(expected, replay(cached, history, batches, fed), atol=1e-6)
+    assert max(fed) == 0 if temporal_mode == 'incremental' else max(fed) <= 3 * N_CAS
+
+
+@pytest.mark.parametrize('temporal_mode', ['incremental', 'truncated'])
+def test_cached_modes_truncate_gradients_in_training(temporal_mode):
+    """training feeds the events after the last chunk with gradients, from states that match a full pass"""
+    batches = make_batches()
+    full_history, history = CasHistory(N_USER, N_CAS), CasHistory(N_USER, N_CAS)
+    full, cached = build('full', full_history, 0.).train(), build(temporal_mode, history, 0.).train()
+    fed = []
+    expected = replay(full, full_history, batches)
+    embeddings = replay(cached, history, batches, fed)
+    assert torch.allclose(expected, embeddings, atol=1e-6)
+    assert max(fed) <= 3 * N_CAS
+    embeddings.sum().backward()
+    users, _, length = history.read(np.arange(N_CAS))
+    # the users of the events before the last chunk of every cascade get no gradient through the aggregator
+    checkpoint = torch.div(length - 1, 3, rounding_mode='floor').clamp(min=0) * 3
+    steps = torch.arange(users.shape[1])
+    tail = (steps >= checkpoint.unsqueeze(dim=1)) & (steps < length.unsqueeze(dim=1))
+    head_only = set(users[steps < checkpoint.unsqueeze(dim=1)].tolist()) - set(users[tail].tolist())
+    assert len(head_only) > 0
+    grad = cached.static_state.weight.grad
+    assert all(float(grad[user].abs().sum()) == 0. for user in head_only)
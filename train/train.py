@@ -1,13 +1,16 @@
 import logging
+import os
 import numpy as np
 import torch
 from tqdm import tqdm
-from utils.my_utils import save_model, load_model, EarlyStopMonitor, Metric
+from utils.my_utils import save_model, load_model, EarlyStopMonitor
 import time
-from model.NODEPT import ODEPT
 import math
+import queue
+import threading
 from utils.data_processing import Data
-from typing import Tuple, Dict, Type
+from utils.profiler import StageProfiler
+from typing import Tuple, Dict, Type, List
 from utils.my_utils import compute_loss
 from torch.distributions.normal import Normal
 
@@ -19,73 +22,261 @@ def select_label(labels, types):
     return {'train': train_idx, 'val': val_idx, 'test': test_idx}
 
 
-def move_to_device(device, *args):
-    results = []
-    for arg in args:
-        if type(arg) is torch.Tensor:
-            results.append(arg.to(dtype=torch.float, device=device))
-        else:
-            results.append(torch.tensor(arg, device=device, dtype=torch.float))
-    return results
+class StreamingMetric:
+    """
+    Accumulate the MSLE and MAPE of predictions batch by batch. The sums stay on the device of the predictions, so
+    updating does not synchronize with the host.
+    """
 
+    def __init__(self):
+        self.square_error, self.percentage_error, self.count = 0., 0., 0
 
-def train_model(num: int, dataset: Data, decoder_data, model, logger: logging.Logger,
+    def update(self, pred: torch.Tensor, label: torch.Tensor):
+        """
+        :param pred: the predicted log2(popularity + 1), tensor of shape (n_cas, n_timestamps)
+        :param label: the true log2(popularity + 1), tensor of shape (n_cas, n_timestamps)
+        """
+        pred, label = pred.detach().to(label.dtype), label
+        self.square_error = self.square_error + torch.sum(torch.square(pred - label))
+        self.percentage_error = self.percentage_error + torch.sum(
+            torch.abs(torch.exp2(pred) - torch.exp2(label)) / torch.exp2(label))
+        self.count += label.numel()
+
+    def result(self) -> Dict[str, float]:
+        """the MSLE and MAPE, NaN with a warning when nothing was scored"""
+        if self.count == 0:
+            logging.getLogger().warning('no predictions to score, the metrics are NaN')
+            return {'msle': math.nan, 'mape': math.nan}
+        return {'msle': float(self.square_error) / self.count, 'mape': float(self.percentage_error) / self.count}
+
+
+def prepare_batch(x, label, cas_labels: torch.Tensor, pin_memory: bool) -> Dict:
+    """
+    Do the host-side work of a batch: build the index masks, convert the interaction features into tensors and
+    gather the labels of the train, val and test cascades
+    :param cas_labels: the log-transformed popularity of every cascade, tensor of shape (n_cas, n_timestamps)
+    """
+    src, dst, trans_cas, trans_time, pub_time, types, cas_idx = x
+    index_dict = select_label(label, types)
+    batch = {'src': src, 'dst': dst, 'trans_cas': trans_cas, 'cas_idx': cas_idx, 'index_dict': index_dict,
+             'target_idx': index_dict['train'] | index_dict['val'] | index_dict['test'],
+             'trans_time': torch.tensor(trans_time, dtype=torch.float),
+             'pub_time': torch.tensor(pub_time, dtype=torch.float),
+             'label': torch.tensor(label, dtype=torch.float),
+             'target_label': {dtype: cas_labels[torch.from_numpy(cas_idx[idx])] if idx.any() else None
+                              for dtype, idx in index_dict.items()}}
+    if pin_memory:
+        for key in ['trans_time', 'pub_time', 'label']:
+            batch[key] = batch[key].pin_memory()
+        for dtype, target_label in batch['target_label'].items():
+            if target_label is not None:
+                batch['target_label'][dtype] = target_label.pin_memory()
+    return batch
+
+
+class BatchPrefetcher:
+    """
+    Iterate over the prepared batches of a dataset, which are prepared by a background thread a few batches ahead
+    of the consumer, so that the model does not wait on the host-side work
+    """
+
+    def __init__(self, dataset: Data, cas_labels: torch.Tensor, batch_size: int, device: torch.device,
+                 depth: int = 2, profiler: StageProfiler = None):
+        """
+        :param depth: the number of batches prepared in advance, 0 to prepare every batch in the calling thread
+        :param profiler: times the preparation of every batch as the 'prepare' stage
+        """
+        self.dataset = dataset
+        self.cas_labels = cas_labels
+        self.batch_size = batch_size
+        self.device = device
+        self.depth = depth
+        self.pin_memory = device.type == 'cuda'
+        self.profiler = profiler if profiler is not None else StageProfiler()
+
+    def prepare(self, x, label) -> Dict:
+        # only timed, it usually runs in the background thread, and in the calling thread it is inside 'data'
+        with self.profiler.stage('prepare', memory=False):
+            return prepare_batch(x, label, self.cas_labels, self.pin_memory)
+
+    def __len__(self):
+        return math.ceil(self.dataset.length / self.batch_size)
+
+    def to_device(self, batch: Dict) -> Dict:
+        for key in ['trans_time', 'pub_time', 'label']:
+            batch[key] = batch[key].to(self.device, non_blocking=self.pin_memory)
+        for dtype, target_label in batch['target_label'].items():
+            if target_label is not None:
+                batch['target_label'][dtype] = target_label.to(self.device, non_blocking=self.pin_memory)
+        return batch
+
+    def produce(self, batches: queue.Queue, stop: threading.Event):
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for x, label in self.dataset.loader(self.batch_size):
+                if not put(self.prepare(x, label)):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for x, label in self.dataset.loader(self.batch_size):
+                yield self.to_device(self.prepare(x, label))
+            return
+        batches, stop = queue.Queue(maxsize=self.depth), threading.Event()
+        worker = threading.Thread(target=self.produce, args=(batches, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield self.to_device(batch)
+        finally:
+            stop.set()
+            worker.join()
+
+
+def train_epoch(model, dataset: Data, decoder_data: torch.Tensor, optimizer: torch.optim.Optimizer,
+                z0_prior: Normal, device: torch.device, param: Dict) -> Tuple[List[float], Dict[str, StreamingMetric]]:
+    """
+    Replay the interactions of a dataset once from empty states, training on the train cascades and scoring the
+    predictions of all target cascades
+    :return: a tuple of (train_loss, epoch_metric), the loss of every trained batch and the metric of each split
+    """
+    profiler = model.profiler
+    model.reset_state()
+    model.train()
+    model.external_memory.reset_memory()
+    train_loss = []
+    epoch_metric = {dtype: StreamingMetric() for dtype in ['train', 'val', 'test']}
+    batches = iter(tqdm(BatchPrefetcher(dataset, decoder_data, param['bs'], device, param['prefetch'], profiler),
+                        desc='training'))
+    while True:
+        # the batches are prepared in the background, so this is the time waiting for them
+        with profiler.stage('data'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        src, dst, trans_cas = batch['src'], batch['dst'], batch['trans_cas']
+        trans_time, pub_time, label = batch['trans_time'], batch['pub_time'], batch['label']
+        index_dict, target_idx = batch['index_dict'], batch['target_idx']
+        pred, first_point = model.forward(src, dst, trans_cas, trans_time, pub_time, target_idx)
+        train_idx = index_dict['train']
+        if batch['target_label']['train'] is not None:
+            target_label = batch['target_label']['train']
+            target_pred = pred[train_idx]
+            target_first_point = first_point[train_idx]
+            optimizer.zero_grad()
+            with profiler.stage('loss'):
+                loss = compute_loss(target_pred, target_label, first_point=target_first_point,
+                                    z0_prior=z0_prior, observe_std=param['observe_std'],
+                                    der_coef=param['lambda1'])
+            with profiler.stage('backward'):
+                loss.backward()
+            with profiler.stage('optimizer'):
+                optimizer.step()
+                # the projected memory was computed from the parameters before the step
+                model.external_memory.invalidate()
+            train_loss.append(loss.item())
+        # val and test cascades are predicted in the same pass, so they are scored here instead of replaying
+        # the interactions for evaluation
+        for dtype, target_label in batch['target_label'].items():
+            if target_label is not None:
+                epoch_metric[dtype].update(pred[index_dict[dtype]], target_label)
+
+        with profiler.stage('store_state'):
+            model.update_state()
+            model.detach_state()
+        profiler.step()
+    return train_loss, epoch_metric
+
+
+def predict_epoch(model, dataset: Data, decoder_data: torch.Tensor, device: torch.device,
+                  param: Dict) -> Dict[str, StreamingMetric]:
+    """replay the interactions of a dataset once from empty states without training, scoring the predictions of all
+    target cascades"""
+    model.reset_state()
+    model.eval()
+    model.external_memory.reset_memory()
+    epoch_metric = {dtype: StreamingMetric() for dtype in ['train', 'val', 'test']}
+    with torch.no_grad():
+        for batch in tqdm(BatchPrefetcher(dataset, decoder_data, param['bs'], device, param['prefetch'],
+                                          model.profiler), desc='predicting'):
+            pred, _ = model.forward(batch['src'], batch['dst'], batch['trans_cas'], batch['trans_time'],
+                                    batch['pub_time'], batch['target_idx'])
+            for dtype, target_label in batch['target_label'].items():
+                if target_label is not None:
+                    epoch_metric[dtype].update(pred[batch['index_dict'][dtype]], target_label)
+            model.update_state()
+            model.detach_state()
+    return epoch_metric
+
+
+def train_model(num: int, dataset: Data, decoder_data: torch.Tensor, model, logger: logging.Logger,
                 early_stopper: EarlyStopMonitor,
-                device: torch.device, param: Dict, metric: Metric, result: Dict, single_metric: Metric):
+                device: torch.device, param: Dict, result: Dict):
     train, val, test = dataset, dataset, dataset
     model = model.to(device)
     logger.info('Start training citation')
     optimizer = torch.optim.Adam(model.parameters(), lr=param['lr'])
     z0_prior = Normal(torch.Tensor([0.0]).to(device), torch.Tensor([1.]).to(device))
+    best_result = {'msle': math.nan, 'mape': math.nan}
+    profiler = model.profiler
 
     for epoch in range(param['epoch']):
-        model.reset_state()
-        model.train()
-        model.external_memory.reset_memory()
         logger.info(f'Epoch {epoch}:')
         epoch_start = time.time()
-        train_loss = []
-        train_kldiv_z0 = []
-        i = 0
-
-        for x, label in tqdm(train.loader(param['bs']), total=math.ceil(train.length / param['bs']),
-                             desc='training'):
-            src, dst, trans_cas, trans_time, pub_time, types = x
-            index_dict = select_label(label, types)
-            i = i + 1
-            target_idx = index_dict['train'] | index_dict['val'] | index_dict['test']
-            trans_time, pub_time, label = move_to_device(device, trans_time, pub_time, label)
-            pred, first_point = model.forward(src, dst, trans_cas, trans_time, pub_time, target_idx)
-            train_idx = index_dict['train']
-            if sum(train_idx) > 0:
-                target, target_time = trans_cas[train_idx], trans_time[train_idx]
-                target_label = torch.tensor(np.array([decoder_data[key] for key in target]))
-                target_label = target_label + 1
-                target_label = torch.log2(target_label)
-                target_label = target_label.to(device)
-                target_pred = pred[train_idx]
-                target_first_point = first_point[train_idx]
-                optimizer.zero_grad()
-                loss = compute_loss(target_pred, target_label, first_point=target_first_point, z0_prior=z0_prior,
-                                    observe_std=param['observe_std'],der_coef=param['lambda1'])
-                loss.backward()
-                optimizer.step()
-                train_loss.append(loss.item())
-
-            model.update_state()
-            model.detach_state()
+        model.cas_ode.stats.reset()
+        profiler.reset()
+        train_loss, epoch_metric = train_epoch(model, train, decoder_data, optimizer, z0_prior, device, param)
 
         epoch_end = time.time()
         logger.info(f"Epoch{epoch}: time_cost:{epoch_end - epoch_start} train_loss:{np.mean(train_loss)}")
+        if model.cas_ode.stats.enabled:
+            logger.info(f"Epoch{epoch}: ode {model.cas_ode.stats.format()}")
+        if profiler.enabled:
+            logger.info(f"Epoch{epoch}: stages {profiler.format()}")
+        if param['profile_trace']:
+            # the events are cleared with the totals, so the trace is written every epoch
+            trace_root, trace_ext = os.path.splitext(param['profile_trace'])
+            trace_path = f'{trace_root}_epoch{epoch}{trace_ext}'
+            profiler.export(trace_path)
+            logger.info(f"Epoch{epoch}: saved the trace of the profiled stages to {trace_path}")
+        if epoch_metric['val'].count == 0:
+            raise ValueError('no val cascade was scored, so early stopping can not compare the epochs')
+        epoch_result = {dtype: epoch_metric[dtype].result() for dtype in epoch_metric}
+        # all splits are scored on the predictions of the training pass, with dropout on and the parameters
+        # changing along the epoch
         for dtype in ['train', 'val', 'test']:
-            metric.info(dtype)
+            logger.info(f"Epoch{epoch}: {dtype} (training pass, dropout on) msle:{epoch_result[dtype]['msle']} "
+                        f"mape:{epoch_result[dtype]['mape']}")
+        stop = early_stopper.early_stop_check(epoch_result['val']['msle'])
+        if early_stopper.best_epoch == epoch:
+            best_result = epoch_result['test']
+        if stop:
+            break
     logger.info('No improvement over {} epochs, stop training'.format(early_stopper.max_round))
     logger.info(f'Loading the best model at epoch {early_stopper.best_epoch}')
     load_model(model, param['model_path'], num)
     logger.info(f'Loaded the best model at epoch {early_stopper.best_epoch} for inference')
+    logger.info(f"Runs:{num} test msle:{best_result['msle']} mape:{best_result['mape']}")
+    result['mlse'].append(best_result['msle'])
+    result['mape'].append(best_result['mape'])
     logger.info(f'multi_predict_point:{param["predict_timestamps"]}')
-    logger.info(f'Runs:{num}\n {metric.history}')
-    metric.save()
     model_save_path=param['model_path']
 
     save_model(model, model_save_path, num)
@@ -0,0 +1,97 @@
+import argparse
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """the command line arguments of the training script, shared with the benchmarks"""
+    parser = argparse.ArgumentParser('hyper parameters of ODEPT')
+    parser.add_argument('--dataset', type=str, help='dataset name ',
+                        default='twitter', choices=['aps', 'twitter', 'weibo', 'synthetic'])
+    parser.add_argument('--bs', type=int, default=50, help='batch size')
+    parser.add_argument('--prefix', type=str, default='test', help='prefix to name a trial')
+    parser.add_argument('--epoch', type=int, default=150, help='number of epochs')
+    parser.add_argument('--lr', type=float, default=1e-4, help='learning rate')
+    parser.add_argument('--run', type=int, default=1, help='number of runs')
+    parser.add_argument('--gpu', type=int, default=0, help='idx for the gpu to use')
+    parser.add_argument('--node_dim', type=int, default=64, help='dimensions of the node embedding')
+    parser.add_argument('--time_dim', type=int, default=16, help='dimensions of the time embedding')
+    parser.add_argument('--patience', type=int, default=15, help='patience for the early stopping strategy')
+    parser.add_argument('--dropout', type=float, default=0.1, help='dropout probability')
+    parser.add_argument('--predictor', type=str, default="linear", choices=["linear", "merge"], help="type of predictor")
+    parser.add_argument('--embedding_module', type=str, default="aggregate", choices=["identity", "aggregate"],
+                        help="type of embedding module")
+    parser.add_argument('--single', action='store_true',
+                        help='whether to use different state updaters and message functions for users and cascades')  # 是否使用不同的update函数
+    parser.add_argument('--use_static', action='store_true',  help='whether use static embedding for users')
+    parser.add_argument('--use_dynamic', action='store_true',
+                        help='whether use dynamic embedding for users and cascades')
+    parser.add_argument('--use_temporal', action='store_true',
+                        help='whether to adopt temporal learning in the cascade embedding module')
+    parser.add_argument('--lambda', type=float, default=0.5,
+                        help='the weight to balance the static result and dynamic result')
+    parser.add_argument('--solver', type=str, default="euler", help='dopri5,rk4,euler')
+    parser.add_argument('--ode_backend', type=str, default='torchdiffeq', choices=['torchdiffeq', 'fixed'],
+                        help='solve by torchdiffeq, or unroll a fixed-step solver (euler, midpoint, rk4) directly')
+    parser.add_argument('--no_adjoint', action='store_true', default=False,
+                        help='back-propagate through the solver directly instead of the adjoint method '
+                             '(per-step recomputation for the fixed backend)')
+    parser.add_argument('--observe_std', type=float, default=0.1,
+                        help='the observe_std of data when compute loss')
+    parser.add_argument('--ode_stats', action='store_true',
+                        help='count and time the function evaluations and steps of the ODE solves, logged per epoch. '
+                             'Nothing is counted without it')
+    parser.add_argument('--dense_output', action='store_true', default=False,
+                        help='keep the interpolant of each solve, so that predictions at other times inside the solved '
+                             'interval do not need a new solve')
+    parser.add_argument('--compile_ode', type=str, default='none', choices=['none', 'fused', 'compile'],
+                        help='evaluate the ODE dynamics through the submodules, as one fused function of functional ops, '
+                             'or compile the fused function by torch.compile (falling back to fused when it fails)')
+    parser.add_argument('--memory_size', type=int, default=16,
+                        help='external memory size')
+    parser.add_argument('--memory_attention', type=str, default='dense', choices=['dense', 'topk'],
+                        help='attend over all slots of the external memory, or over the topk slots of each query only')
+    parser.add_argument('--memory_topk', type=int, default=32,
+                        help='number of memory slots attended by each query in the topk attention')
+    parser.add_argument('--memory_chunk', type=int, default=4096,
+                        help='number of memory slots scored at once when searching the topk slots')
+    parser.add_argument('--predict_timestamps', type=str, default='',
+                        help='time_point_timestamp_to_predict')
+    parser.add_argument('--lambda1', type=int, default=50,
+                        help='der_coef')
+    parser.add_argument('--test', action='store_true', default=False,
+                        help='is_test_model')
+    parser.add_argument('--self_evolution', action='store_true', default=False,
+                        help='is_only_self_evolution')
+    parser.add_argument('--test_model_path', type=str, default='',
+                        help='test_model_path')
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='whether to skip the cache of preprocessed data under data/cache')
+    parser.add_argument('--chunk_size', type=int, default=1000000,
+                        help='number of interactions read into memory at once when preprocessing')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='number of batches prepared in the background ahead of training, 0 to disable')
+    parser.add_argument('--check_level', type=str, default='sampled', choices=['off', 'sampled', 'full'],
+                        help='how often to check for NaN values and timing violations, never, in one batch out of '
+                             'check_interval batches, or in every batch')
+    parser.add_argument('--check_interval', type=int, default=100,
+                        help='number of batches between the checked batches of the sampled check level')
+    parser.add_argument('--temporal_mode', type=str, default='full', choices=['full', 'truncated', 'incremental'],
+                        help='how the temporal aggregators consume the history of cascades, full recomputes it '
+                             'every time, truncated and incremental fold the events into states cached as they '
+                             'arrive in the same pass, and a target feeds only the events after its cached state. '
+                             'Truncated caches the state every temporal_chunk events, incremental after the last '
+                             'event out of training and like truncated in training, where the gradients go through '
+                             'the last temporal_chunk events at most. With --use_dynamic the cached states were '
+                             'computed from older user states, so incremental and truncated differ from full')
+    parser.add_argument('--temporal_chunk', type=int, default=20,
+                        help='number of events between the cached states of the truncated temporal mode')
+    parser.add_argument('--profile_stages', type=str, default='',
+                        help="comma-separated stages of a batch to time and measure memory, 'all' for every stage, "
+                             "from prepare,data,message,state_update,history,embedding,encoder_z0,ode,loss,backward,"
+                             "optimizer,store_state. prepare runs in the thread of the prefetcher and is only timed, "
+                             "data is the wait for a prepared batch. The memory is the peak allocated memory on GPUs "
+                             "and the growth of the resident size on CPUs, where the peak resident size of the "
+                             "process is reported once")
+    parser.add_argument('--profile_trace', type=str, default='',
+                        help='the path to export the profiled stages of every epoch as a Chrome trace, written to '
+                             '<path>_epoch<n>, empty for no trace')
+    return parser
@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+from typing import Tuple
+
+
+class CasHistory:
+    """
+    An append-only store of the (user, time) events of every cascade. The events of a cascade occupy a contiguous
+    block of a shared pool, located by the offset of the cascade, and a block is moved to a block of twice the
+    capacity at the end of the pool when the cascade outgrows it. Each event takes 4 bytes for the user and 4 bytes
+    for the time.
+    """
+
+    def __init__(self, num_user: int, num_cas: int, device: torch.device = torch.device('cpu'),
+                 min_capacity: int = 4):
+        self.num_user = num_user
+        self.num_cas = num_cas
+        self.device = device
+        self.min_capacity = min_capacity
+        self.offset = torch.zeros(num_cas, dtype=torch.long, device=device)
+        self.capacity = torch.zeros(num_cas, dtype=torch.long, device=device)
+        self.length = torch.zeros(num_cas, dtype=torch.long, device=device)
+        self.pub_time = torch.zeros(num_cas, dtype=torch.float, device=device)
+        self.users = torch.zeros(num_cas * min_capacity, dtype=torch.int32, device=device)
+        self.times = torch.zeros(num_cas * min_capacity, dtype=torch.float, device=device)
+        self.used = 0
+
+    def init(self):
+        """forget all events, the blocks of cascades are kept and refilled from their beginning"""
+        self.length.zero_()
+        self.pub_time.zero_()
+
+    def to_index(self, cascades: np.ndarray) -> torch.Tensor:
+        return torch.as_tensor(cascades, dtype=torch.long).to(self.device)
+
+    def reserve(self, size: int):
+        """make sure that the pool can hold `size` events"""
+        if size <= len(self.users):
+            return
+        pool_size = len(self.users)
+        while pool_size < size:
+            pool_size *= 2
+        users = torch.zeros(pool_size, dtype=self.users.dtype, device=self.device)
+        times = torch.zeros(pool_size, dtype=self.times.dtype, device=self.device)
+        users[:self.used] = self.users[:self.used]
+        times[:self.used] = self.times[:self.used]
+        self.users, self.times = users, times
+
+    def grow(self, cascades: torch.Tensor, need: torch.Tensor):
+        """
+        Move the events of cascades into new blocks at the end of the pool
+        :param cascades: the ids of cascades without duplicates, tensor of shape (n_cas)
+        :param need: the number of events that each cascade should be able to hold, tensor of shape (n_cas)
+        """
+        capacity = torch.exp2(torch.ceil(torch.log2(need.double()))).long()
+        capacity = torch.maximum(capacity, self.capacity[cascades] * 2).clamp(min=self.min_capacity)
+        offset = self.used + torch.cumsum(capacity, dim=0) - capacity
+        self.reserve(self.used + int(capacity.sum()))
+        length = self.length[cascades]
+        if int(length.sum()) > 0:
+            rank = self.get_rank(length)
+            old_pos = torch.repeat_interleave(self.offset[cascades], length) + rank
+            new_pos = torch.repeat_interleave(offset, length) + rank
+            self.users[new_pos] = self.users[old_pos]
+            self.times[new_pos] = self.times[old_pos]
+        self.offset[cascades] = offset
+        self.capacity[cascades] = capacity
+        self.used += int(capacity.sum())
+
+    @staticmethod
+    def get_rank(counts: torch.Tensor) -> torch.Tensor:
+        """the position of each element inside its group, where the sizes of consecutive groups are `counts`"""
+        ends = torch.cumsum(counts, dim=0)
+        return torch.arange(int(ends[-1]), device=counts.device) - torch.repeat_interleave(ends - counts, counts)
+
+    def insert(self, cascades: np.ndarray, users: np.ndarray, times: torch.Tensor, pub_times: torch.Tensor):
+        """
+        Append a batch of events, the events of a cascade are kept in the order of the batch
+        :param cascades: the cascade of each event, ndarray of shape (batch)
+        :param users: the user of each event, ndarray of shape (batch)
+        :param times: the happening timestamp of each event, tensor of shape (batch)
+        :param pub_times: the publication timestamp of the cascade of each event, tensor of shape (batch)
+        """
+        if len(cascades) == 0:
+            return
+        cas = self.to_index(cascades)
+        order = torch.argsort(cas, stable=True)
+        unique_cas, counts = torch.unique_consecutive(cas[order], return_counts=True)
+        rank = torch.empty_like(order)
+        rank[order] = self.get_rank(counts)
+        need = self.length[unique_cas] + counts
+        grow = need > self.capacity[unique_cas]
+        if grow.any():
+            self.grow(unique_cas[grow], need[grow])
+        pos = self.offset[cas] + self.length[cas] + rank
+        times, pub_times = times.to(self.device), pub_times.to(self.device)
+        self.users[pos] = torch.as_tensor(users).to(device=self.device, dtype=torch.int32)
+        self.times[pos] = (times - pub_times).to(self.times.dtype)
+        self.length[unique_cas] = need
+        self.pub_time[cas] = pub_times.to(self.pub_time.dtype)
+
+    def read(self, cascades: np.ndarray, k: int = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Read the last k events of cascades
+        :param cascades: the ids of cascades, ndarray of shape (n_cas)
+        :param k: the maximum number of events to read for each cascade, None to read all events
+        :return: a tuple of (users, times, length), users and times are padded with 0 and are tensors of shape
+                 (n_cas, max_length), where times are the durations since the publication of cascades, length is
+                 the number of events read for each cascade, tensor of shape (n_cas)
+        """
+        cas = self.to_index(cascades)
+        total = self.length[cas]
+        length = total if k is None else total.clamp(max=k)
+        width = int(length.max()) if len(cas) > 0 else 0
+        steps = torch.arange(width, device=self.device)
+        valid = steps.unsqueeze(dim=0) < length.unsqueeze(dim=1)
+        pos = (self.offset[cas] + total - length).unsqueeze(dim=1) + steps
+        pos = torch.where(valid, pos, torch.zeros_like(pos))
+        users = torch.where(valid, self.users[pos].long(), torch.zeros_like(pos))
+        times = torch.where(valid, self.times[pos], torch.zeros((), device=self.device))
+        return users, times, length
+
+    def get_cas_pub_time(self, cascades: np.ndarray) -> torch.Tensor:
+        """the publication timestamps of cascades, tensor of shape (n_cas)"""
+        return self.pub_time[self.to_index(cascades)]
@@ -1,52 +1,197 @@
+import atexit
+import hashlib
 import logging
+import os
 import pickle as pk
+import shutil
+import tempfile
 import time
+from typing import Dict, Iterator, List, Tuple
 
 import numpy as np
 import pandas as pd
+import torch
+
+# bump it whenever the preprocessing changes, so that caches written by an older version are ignored
+CACHE_VERSION = 2
 
 
 class Data:
     def __init__(self, data, is_split=False):
-        self.srcs = data['src'].values
-        self.dsts = data['dst'].values
-        self.times = data['abs_time'].values
-        self.trans_cascades = data['cas'].values
-        self.pub_times = data['pub_time'].values
-        self.labels = data['label'].values
+        self.srcs = np.asarray(data['src'])
+        self.dsts = np.asarray(data['dst'])
+        self.times = np.asarray(data['abs_time'])
+        self.trans_cascades = np.asarray(data['cas'])
+        self.pub_times = np.asarray(data['pub_time'])
+        self.labels = np.asarray(data['label'])
         self.length = len(self.srcs)
         self.is_split = is_split
         if is_split:
-            self.types = data['type'].values
+            self.types = np.asarray(data['type'])
+            # the row of the cascade of each interaction in the label tensor returned by `get_split_data`
+            self.cas_idxs = np.asarray(data['cas_idx'])
 
     def loader(self, batch):
         for i in range(0, len(self.srcs), batch):
             right = min(i + batch, self.length)
             if self.is_split:
                 yield (self.srcs[i:right], self.dsts[i:right], self.trans_cascades[i:right],
-                       self.times[i:right], self.pub_times[i:right], self.types[i:right]), self.labels[i:right]
+                       self.times[i:right], self.pub_times[i:right], self.types[i:right],
+                       self.cas_idxs[i:right]), self.labels[i:right]
             else:
                 yield (self.srcs[i:right], self.dsts[i:right], self.trans_cascades[i:right],
                        self.times[i:right], self.pub_times[i:right]), self.labels[i:right]
 
+    def columns(self):
+        columns = {'src': self.srcs, 'dst': self.dsts, 'abs_time': self.times, 'cas': self.trans_cascades,
+                   'pub_time': self.pub_times, 'label': self.labels}
+        if self.is_split:
+            columns['type'] = self.types
+            columns['cas_idx'] = self.cas_idxs
+        return columns
 
-def get_label(x: pd.DataFrame, observe_time, label):
-    id = np.searchsorted(x['time'], observe_time, side='left')
-    casid = x['cas'].values[0]
-    if casid in label and id >= 10:
-        length = min(id, 100) - 1
+    def save(self, path: str):
+        """save every column as a .npy file under the directory `path`"""
+        os.makedirs(path, exist_ok=True)
+        for name, column in self.columns().items():
+            np.save(os.path.join(path, f'{name}.npy'), column)
 
-        x.iloc[length, x.columns.get_loc('label')] = label[casid] - id
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = None) -> 'Data':
+        """
+        load the columns saved by `save`
+        :param mmap_mode: if given, the columns are memory-mapped instead of being read into memory, and `loader`
+                          yields views of the mapped files, so that only the pages of the batches in use are resident
+        """
+        is_split = os.path.exists(os.path.join(path, 'type.npy'))
+        names = ['src', 'dst', 'abs_time', 'cas', 'pub_time', 'label'] + (['type', 'cas_idx'] if is_split else [])
+        return cls({name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in names},
+                   is_split=is_split)
 
-        return [x.iloc[:length + 1, :]]
+
+def to_cascade_ids(column: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert a column of cascade ids, which is parsed as float when the file has blanks
+    :return: a tuple of (ids, valid), the ids as int64 and whether each id is a non-negative integer, the invalid
+             ones are set to -1
+    """
+    if pd.api.types.is_integer_dtype(column):
+        ids = column.to_numpy(dtype=np.int64)
+        valid = ids >= 0
     else:
-        return []
+        values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+        valid = np.isfinite(values) & (values >= 0) & (values == np.floor(values))
+        ids = np.where(valid, values, -1).astype(np.int64)
+    return ids, valid
+
+
+def check_cascade_ids(metadata: pd.DataFrame) -> np.ndarray:
+    """
+    The cascades are indexed by id in arrays of size max id + 1, so the ids must be unique non-negative integers
+    :return: the ids as int64
+    """
+    if len(metadata) == 0:
+        raise ValueError('the metadata has no cascades')
+    ids, valid = to_cascade_ids(metadata['casid'])
+    if not valid.all():
+        raise ValueError(f'the cascade ids of the metadata should be non-negative integers, found '
+                         f'{metadata["casid"].values[~valid][:10].tolist()}')
+    if len(np.unique(ids)) != len(ids):
+        raise ValueError('the cascade ids of the metadata should be unique')
+    return ids
+
+
+def get_pub_times(metadata: pd.DataFrame):
+    """
+    :return: a tuple of (pub_times, has_metadata), the publication time of each cascade and whether each cascade
+             appears in the metadata, both are ndarrays indexed by cascade id
+    """
+    ids = check_cascade_ids(metadata)
+    n_cas = ids.max() + 1
+    pub_times = np.zeros(n_cas, dtype=metadata['pub_time'].dtype)
+    pub_times[ids] = metadata['pub_time'].values
+    has_metadata = np.zeros(n_cas, dtype=bool)
+    has_metadata[ids] = True
+    return pub_times, has_metadata
+
+
+def read_interactions(dataset, metadata: pd.DataFrame, chunk_size: int, run_dir: str) -> List[Dict[str, np.ndarray]]:
+    """
+    Read the interactions of a dataset chunk by chunk, drop the ones whose cascades are missing in the metadata, and
+    spill every chunk sorted by interaction id to `run_dir`
+    :param metadata: the cascade id and publication time of each cascade
+    :param chunk_size: the number of interactions held in memory at once
+    :return: the sorted runs, each of which maps a column name to a memory-mapped ndarray
+    """
+    _, has_metadata = get_pub_times(metadata)
+    n_cas = len(has_metadata)
+    names = ['id', 'src', 'dst', 'cas', 'time']
+    n_runs = 0
+    for chunk in pd.read_csv(f'data/{dataset}.csv', usecols=names, chunksize=chunk_size):
+        if len(chunk) == 0:
+            continue
+        cas, valid = to_cascade_ids(chunk['cas'])
+        chunk = chunk.assign(cas=cas)[valid & (cas < n_cas) & has_metadata[np.clip(cas, 0, n_cas - 1)]]
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.sort_values(by='id', kind='stable')
+        for name in names:
+            np.save(os.path.join(run_dir, f'{name}_{n_runs}.npy'), chunk[name].values)
+        n_runs += 1
+    if n_runs == 0:
+        raise ValueError(f'data/{dataset}.csv has no interactions of the cascades in the metadata')
+    return [{name: np.load(os.path.join(run_dir, f'{name}_{i}.npy'), mmap_mode='r') for name in names}
+            for i in range(n_runs)]
 
 
+def merge_runs(runs: List[Dict[str, np.ndarray]], block_size: int) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Merge the sorted runs by interaction id, yielding the interactions in blocks of at most about `block_size` rows
+    """
+    names = list(runs[0].keys()) if len(runs) > 0 else []
+    run_block = max(block_size // max(len(runs), 1), 1)
+    positions = [0] * len(runs)
+    buffers = [{name: run[name][:0] for name in names} for run in runs]
+    while True:
+        for k, run in enumerate(runs):
+            if len(buffers[k]['id']) == 0 and positions[k] < len(run['id']):
+                buffers[k] = {name: np.asarray(run[name][positions[k]:positions[k] + run_block]) for name in names}
+                positions[k] += run_block
+        active = [k for k in range(len(runs)) if len(buffers[k]['id']) > 0]
+        if len(active) == 0:
+            return
+        # interactions up to the smallest buffered id of the runs that still have unread rows are safe to emit
+        pending = [buffers[k]['id'][-1] for k in active if positions[k] < len(runs[k]['id'])]
+        bound = min(pending) if len(pending) > 0 else None
+        parts = []
+        for k in active:
+            n = len(buffers[k]['id']) if bound is None else np.searchsorted(buffers[k]['id'], bound, side='right')
+            parts.append({name: buffers[k][name][:n] for name in names})
+            buffers[k] = {name: buffers[k][name][n:] for name in names}
+        block = {name: np.concatenate([part[name] for part in parts]) for name in names}
+        order = np.argsort(block['id'], kind='stable')
+        yield {name: column[order] for name, column in block.items()}
 
 
-def get_split_data(dataset, observe_time, predict_time, restruct_time, time_unit, all_data, min_time, metadata, log,
-                   param):
+def get_rank(keys: np.ndarray) -> np.ndarray:
+    """the number of earlier occurrences of every key in `keys`"""
+    rank = np.zeros(len(keys), dtype=np.int64)
+    if len(keys) > 0:
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        rank[order] = np.arange(len(keys)) - np.repeat(starts, np.diff(np.r_[starts, len(keys)]))
+    return rank
+
+
+def get_split_data(dataset, observe_time, predict_time, restruct_time, time_unit, runs, min_time, metadata, log,
+                   param, block_size, path, min_length=10, max_length=100, transformation=None):
+    """
+    Split the cascades and write the columns of their kept interactions into .npy files under the directory `path`
+    while streaming the runs, the returned data maps those files
+    :param transformation: the function that adds the abs_time column to the interactions and transforms the
+                           popularity, with the arguments of `data_transformation`, which is the default
+    """
     def data_split(legal_cascades, train_portion=0.7, val_portion=0.15):
         """
         set cas type, 1 for train cas, 2 for val cas, 3 for test cas , and 0 for other cas that will be dropped
@@ -79,48 +224,172 @@ def get_split_data(dataset, observe_time, predict_time, restruct_time, time_unit
         return all_idx, type_map
 
 
-    all_label = all_data[all_data['time'] < predict_time * time_unit].groupby(by='cas', as_index=False)['id'].count()
-    all_label = dict(zip(all_label['cas'], all_label['id']))
-    m_data = []
-    all_data_condition = all_data.copy(deep=True)
-    for cas, df in all_data.groupby(by='cas'):
-        m_data.extend(get_label(df, observe_time * time_unit, all_label))
-    all_data = pd.concat(m_data, axis=0)
+    # count the interactions of each cascade before the observation time and the prediction time
+    n_cas = metadata['casid'].max() + 1
+    observed, label_count = np.zeros(n_cas, dtype=np.int64), np.zeros(n_cas, dtype=np.int64)
+    for run in runs:
+        for i in range(0, len(run['id']), block_size):
+            cascades, times = np.asarray(run['cas'][i:i + block_size]), np.asarray(run['time'][i:i + block_size])
+            observed += np.bincount(cascades[times < observe_time * time_unit], minlength=n_cas)
+            label_count += np.bincount(cascades[times < predict_time * time_unit], minlength=n_cas)
+    lengths = np.where((label_count > 0) & (observed >= min_length), np.minimum(observed, max_length), 0)
+    label_values = label_count - observed
+    all_idx, _ = data_split(np.flatnonzero((lengths > 0) & (label_values != -1)))
+    cas_type = np.zeros(n_cas, dtype=np.int64)
+    for code, dtype in enumerate(['train', 'val', 'test'], 1):
+        cas_type[all_idx[dtype]] = code
     num_timestamps = restruct_time - observe_time
-    all_idx, type_map = data_split(all_data[all_data['label'] != -1]['cas'].values)
-    all_data['type'] = all_data['cas'].apply(lambda x: type_map[x])
-    all_data = all_data[all_data['type'] != 0]
-    cas_id = all_data['cas'].unique()
-    all_data_condition = all_data_condition[all_data_condition['cas'].isin(cas_id)]
-    cas_popularity_dict = {}
-    for cas, df in all_data_condition.groupby(by='cas'):
-        popularity_array = np.zeros(num_timestamps)
-        for ts in range(num_timestamps):
-            popularity_array[ts] = df[df['time'] <= (observe_time + ts) * time_unit]['id'].count()-df[df['time'] <= observe_time  * time_unit]['id'].count()
-        cas_popularity_dict[cas] = popularity_array
-    cas_popularity = data_transformation(dataset, all_data, cas_popularity_dict, time_unit, min_time,
-                                         param)
+    last_time = (restruct_time - 1) * time_unit
+    thresholds = (observe_time + np.arange(num_timestamps)) * time_unit
+    # the kept interactions of a split cascade are its first `lengths` ones, stored together in id order, so the
+    # position of every kept interaction is known before streaming and the columns are written in place
+    kept = np.where(cas_type != 0, lengths, 0)
+    cas_start = np.cumsum(kept) - kept
+    n_rows = int(kept.sum())
+    pub_times = get_pub_times(metadata)[0]
+    # a column may be parsed as int in one chunk and as float in another, use the type of the whole file
+    dtypes = {name: np.result_type(*[run[name].dtype for run in runs]) for name in ['id', 'src', 'dst', 'cas', 'time']}
+    dtypes.update({'pub_time': pub_times.dtype, 'label': label_values.dtype, 'type': cas_type.dtype})
+    split_cas = np.flatnonzero(cas_type != 0)
+    split_pos = np.full(n_cas, -1, dtype=np.int64)
+    split_pos[split_cas] = np.arange(len(split_cas))
+    # the number of interactions of each split cascade in every interval between two thresholds
+    popularity = np.zeros((len(split_cas), num_timestamps), dtype=np.int64)
+    # id and time are only read by the transformation, so they are not kept with the other columns
+    scratch_dir = tempfile.mkdtemp(dir=path)
+    columns = {name: np.lib.format.open_memmap(
+        os.path.join(scratch_dir if name in ['id', 'time'] else path, f'{name}.npy'), mode='w+', dtype=dtype,
+        shape=(n_rows,)) for name, dtype in dtypes.items()}
+    seen = np.zeros(n_cas, dtype=np.int64)
+    for block in merge_runs(runs, block_size):
+        cascades, times = block['cas'], block['time']
+        rank = seen[cascades] + get_rank(cascades)
+        seen += np.bincount(cascades, minlength=n_cas)
+        rows = np.flatnonzero((rank < lengths[cascades]) & (cas_type[cascades] != 0))
+        row_cas, row_rank = cascades[rows], rank[rows]
+        positions = cas_start[row_cas] + row_rank
+        for name in ['id', 'src', 'dst', 'cas', 'time']:
+            columns[name][positions] = block[name][rows]
+        columns['pub_time'][positions] = pub_times[row_cas]
+        columns['label'][positions] = np.where(row_rank == lengths[row_cas] - 1, label_values[row_cas], -1)
+        columns['type'][positions] = cas_type[row_cas]
+        condition = (cas_type[cascades] != 0) & (times <= last_time)
+        np.add.at(popularity, (split_pos[cascades[condition]],
+                               np.searchsorted(thresholds, times[condition], side='left')), 1)
+    for column in columns.values():
+        column.flush()
+    # the `ts`-th column is the number of interactions in (observe_time, observe_time + ts] of each cascade
+    popularity = np.cumsum(popularity, axis=1)
+    popularity = (popularity - popularity[:, :1]).astype(np.float64)
+    cas_popularity_dict = dict(zip(split_cas, popularity))
+    all_data = pd.DataFrame(columns, copy=False)
+    if transformation is None:
+        transformation = data_transformation
+    cas_popularity = transformation(dataset, all_data, cas_popularity_dict, time_unit, min_time, param)
+    label_cas = np.array(list(cas_popularity.keys()))
+    order = np.argsort(label_cas, kind='stable')
+    label_cas = label_cas[order]
+    cas_labels = torch.log2(torch.from_numpy(np.stack(list(cas_popularity.values()))[order]) + 1)
+    cas_idx = np.searchsorted(label_cas, all_data['cas'].values)
+    # every cascade should have a label row, otherwise it would read the row of its neighbour
+    missing = label_cas[np.minimum(cas_idx, len(label_cas) - 1)] != all_data['cas'].values
+    if missing.any():
+        raise ValueError(f'no popularity for cascades {np.unique(all_data["cas"].values[missing])[:10].tolist()}')
+    all_data['cas_idx'] = cas_idx
+    # the columns added or replaced by the transformation are in memory, write them next to the mapped ones
+    for name, column in Data(all_data, is_split=True).columns().items():
+        file = os.path.join(path, f'{name}.npy')
+        if not (name in columns and np.shares_memory(column, columns[name])):
+            np.save(f'{file}.tmp.npy', column)
+            os.replace(f'{file}.tmp.npy', file)
+    del all_data, columns
+    shutil.rmtree(scratch_dir, ignore_errors=True)
     pk.dump(all_idx, open(f'data/{dataset}_idx.pkl', 'wb'))
     log.info(
-        f"Total Trans num is {len(all_data)}, Train cas num is {len(all_idx['train'])}, "
+        f"Total Trans num is {n_rows}, Train cas num is {len(all_idx['train'])}, "
         f"Val cas num is {len(all_idx['val'])}, Test cas num is {len(all_idx['test'])}")
-    return Data(all_data, is_split=True), cas_popularity
+    return Data.load(path, mmap_mode='c'), cas_labels
+
+
+
+def get_cache_path(dataset, observe_time, predict_time, restruct_time, train_time, val_time, test_time,
+                   time_unit, transformation=None) -> str:
+    """
+    Locate the cache of a preprocessed dataset. The key fingerprints the raw files (by size and modification time)
+    and every setting that affects preprocessing, so changing any of them leads to a fresh cache. A transformation
+    is identified by its qualified name (the repr for objects without one, such as partials), so changing the body
+    of a transformation under the same name needs `no_cache`.
+    """
+    if transformation is not None:
+        transformation = (getattr(transformation, '__module__', None),
+                          getattr(transformation, '__qualname__', repr(transformation)))
+    key = hashlib.sha1(repr((CACHE_VERSION, dataset, observe_time, predict_time, restruct_time, train_time, val_time,
+                             test_time, time_unit, transformation)).encode())
+    for path in [f'data/{dataset}.csv', f'data/{dataset}_metadata.csv']:
+        stat = os.stat(path)
+        key.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return f'data/cache/{dataset}_{key.hexdigest()[:16]}'
 
 
+def save_cache(path: str, tmp_path: str, cas_labels: torch.Tensor, param_updates: dict, idx_path: str):
+    """complete the preprocessed data written into the temporary directory `tmp_path` and move it to `path`"""
+    np.save(os.path.join(tmp_path, 'cas_labels.npy'), cas_labels.numpy())
+    pk.dump(param_updates, open(os.path.join(tmp_path, 'param.pkl'), 'wb'))
+    shutil.copyfile(idx_path, os.path.join(tmp_path, 'idx.pkl'))
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another run has written the same cache meanwhile
+        shutil.rmtree(tmp_path)
+
+
+def load_cache(path: str, idx_path: str, param):
+    # copy-on-write mapping keeps the columns writable for torch without reading them into memory
+    data = Data.load(path, mmap_mode='c')
+    cas_labels = torch.from_numpy(np.load(os.path.join(path, 'cas_labels.npy')))
+    param.update(pk.load(open(os.path.join(path, 'param.pkl'), 'rb')))
+    shutil.copyfile(os.path.join(path, 'idx.pkl'), idx_path)
+    return data, cas_labels
+
 
 def get_data(dataset, observe_time, predict_time, restruct_time, train_time, val_time, test_time, time_unit,
-             log: logging.Logger, param):
+             log: logging.Logger, param, transformation=None):
+    """
+    Load the preprocessed dataset from its cache, or preprocess it and cache it. The returned columns are memory
+    mapped in both cases, with `no_cache` from a temporary directory
+    :param transformation: passed to `get_split_data`, its qualified name is part of the cache key
+    """
     a = time.time()
-    data: pd.DataFrame = pd.read_csv(f'data/{dataset}.csv')
-    metadata = pd.read_csv(f'data/{dataset}_metadata.csv')
-    min_time = min(metadata['pub_time'])
-    data = pd.merge(data, metadata, left_on='cas', right_on='casid')
-    data = data[['id', 'src', 'dst', 'cas', 'time', 'pub_time']]
-    param['max_time'] = {'user': 1, 'cas': param['observe_time']}
-    data['label'] = -1
-    data.sort_values(by='id', inplace=True, ignore_index=True)
-    return_data = get_split_data(dataset, observe_time, predict_time, restruct_time, time_unit, data, min_time,
-                                 metadata, log, param)
+    cache_path = get_cache_path(dataset, observe_time, predict_time, restruct_time, train_time, val_time, test_time,
+                                time_unit, transformation)
+    idx_path = f'data/{dataset}_idx.pkl'
+    if not param['no_cache'] and os.path.exists(cache_path):
+        log.info(f"Loading preprocessed data from {cache_path}")
+        return_data = load_cache(cache_path, idx_path, param)
+    else:
+        origin_param = dict(param)
+        metadata = pd.read_csv(f'data/{dataset}_metadata.csv')
+        metadata['casid'] = check_cascade_ids(metadata)
+        min_time = min(metadata['pub_time'])
+        param['max_time'] = {'user': 1, 'cas': param['observe_time']}
+        if param['no_cache']:
+            # the columns are mapped from a directory that is removed at exit
+            data_path = tempfile.mkdtemp(dir='data')
+            atexit.register(shutil.rmtree, data_path, True)
+        else:
+            data_path = f'{cache_path}.{os.getpid()}.tmp'
+            os.makedirs(data_path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir='data') as run_dir:
+            runs = read_interactions(dataset, metadata, param['chunk_size'], run_dir)
+            return_data = get_split_data(dataset, observe_time, predict_time, restruct_time, time_unit, runs,
+                                         min_time, metadata, log, param, param['chunk_size'], data_path,
+                                         transformation=transformation)
+            del runs
+        if not param['no_cache']:
+            param_updates = {key: value for key, value in param.items()
+                             if key not in origin_param or origin_param[key] is not value}
+            save_cache(cache_path, data_path, return_data[1], param_updates, idx_path)
+            return_data = load_cache(cache_path, idx_path, param)
     b = time.time()
     log.info(f"Time cost for loading data is {b - a}s")
     return return_data
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+import torch
+from contextlib import contextmanager, nullcontext
+from typing import Dict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the stages of a training batch, in the order they run, 'prepare' runs ahead in the thread of the prefetcher and
+# 'data' is the wait of the training loop for a prepared batch
+STAGES = ['prepare', 'data', 'message', 'state_update', 'history', 'embedding', 'encoder_z0', 'ode', 'loss', 'backward',
+          'optimizer', 'store_state']
+NULL_STAGE = nullcontext()
+
+
+def resident_memory() -> int:
+    """the current resident size of the process in bytes, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StageProfiler:
+    """
+    Time the stages of every batch and record their memory. On GPUs that is the peak of the allocated memory during
+    the stage, and on CPUs the largest growth of the resident size of the process over the stage, since the peak
+    resident size is kept for the lifetime of the process and is reported once, not per stage. The profiled stages
+    are optionally kept as a Chrome trace, which can be opened in chrome://tracing or Perfetto, up to `max_events`
+    events between two resets, one row per thread. Stages that are not profiled enter a shared null context.
+    """
+
+    def __init__(self, stages: str = '', device: torch.device = torch.device('cpu'), trace: bool = False,
+                 max_events: int = 100000):
+        """
+        :param stages: the comma-separated stages to profile, 'all' for every stage, '' for none
+        :param trace: whether to keep an event of every profiled stage for `export`
+        :param max_events: the number of kept events, the later ones are dropped and counted
+        """
+        if stages == 'all':
+            self.stages = set(STAGES)
+        else:
+            self.stages = {stage for stage in stages.split(',') if stage}
+        unknown = self.stages - set(STAGES)
+        if unknown:
+            raise ValueError(f"Profiling stages {sorted(unknown)} not supported, choose from {STAGES}")
+        self.enabled = len(self.stages) > 0
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.trace = trace
+        self.max_events = max_events
+        self.n_batch = 0
+        self.start = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        """forget the totals and the trace events"""
+        self.totals = {stage: {'time': 0., 'count': 0, 'memory': 0} for stage in STAGES if stage in self.stages}
+        self.events = []
+        self.dropped_events = 0
+
+    def step(self):
+        """move to the next batch"""
+        self.n_batch += 1
+
+    def stage(self, name: str, memory: bool = True):
+        """
+        :param memory: whether to measure the memory of the stage, a stage that runs in another thread only times
+                       itself, since syncing the device or resetting its peak would disturb the stages of the
+                       training loop
+        """
+        if name not in self.stages:
+            return NULL_STAGE
+        return self.record(name, memory)
+
+    def process_peak_memory(self) -> int:
+        """the peak resident size of the process in bytes since it started, 0 where it is not available"""
+        if resource is not None:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return 0
+
+    @contextmanager
+    def record(self, name: str, memory: bool = True):
+        start_memory = 0
+        if memory and self.cuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        elif memory:
+            start_memory = resident_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if memory and self.cuda:
+                torch.cuda.synchronize(self.device)
+            end = time.perf_counter()
+            stage_memory = 0
+            if memory and self.cuda:
+                stage_memory = torch.cuda.max_memory_allocated(self.device)
+            elif memory and start_memory is not None:
+                stage_memory = max(resident_memory() - start_memory, 0)
+            total = self.totals[name]
+            total['time'] += end - start
+            total['count'] += 1
+            total['memory'] = max(total['memory'], stage_memory)
+            if self.trace and len(self.events) >= self.max_events:
+                self.dropped_events += 1
+            elif self.trace:
+                self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': threading.get_ident(),
+                                    'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6,
+                                    'args': {'batch': self.n_batch, 'memory': stage_memory}})
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        the total time in seconds, the mean time in milliseconds and the memory in MB of each stage, which is the
+        peak allocated memory on GPUs and the growth of the resident size on CPUs
+        """
+        return {stage: {'time': total['time'], 'mean_ms': total['time'] * 1000 / max(total['count'], 1),
+                        'memory_mb': total['memory'] / 2 ** 20}
+                for stage, total in self.totals.items()}
+
+    def format(self) -> str:
+        stages = ' '.join(f"{stage}:{result['time']:.4g}s/{result['mean_ms']:.4g}ms/{result['memory_mb']:.1f}MB"
+                          for stage, result in self.summary().items())
+        if self.cuda:
+            return f"{stages} (peak allocated memory)"
+        return f"{stages} (growth of the resident size) process_peak_rss:{self.process_peak_memory() / 2 ** 20:.1f}MB"
+
+    def export(self, path: str):
+        """write the trace events since the last reset in the Chrome trace format"""
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                       'otherData': {'dropped_events': self.dropped_events}}, file)
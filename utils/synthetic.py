@@ -0,0 +1,106 @@
+"""
+Generate a synthetic dataset in the format read by `get_data`: `data/{name}.csv` with the columns id, src, dst,
+cas, time, where time is the duration since the publication of the cascade and ids follow the absolute time, and
+`data/{name}_metadata.csv` with the columns casid, pub_time.
+Each cascade is the cluster of a Hawkes process: every event triggers the next events of the cascade after a
+power-law delay, and the sizes of cascades and the influence of users are heavy-tailed.
+Run from the root of the repository:
+    python -m utils.synthetic --name synthetic --users 10000 --cascades 2000 --events 200000
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+
+def get_sizes(rng: np.random.Generator, n_cas: int, n_events: int, sigma: float) -> np.ndarray:
+    """split `n_events` into `n_cas` lognormal cascade sizes of at least 1"""
+    weights = rng.lognormal(0., sigma, n_cas)
+    sizes = np.floor(weights / weights.sum() * (n_events - n_cas)).astype(np.int64) + 1
+    # hand the remainder of the rounding to the largest cascades
+    sizes[np.argsort(-weights)[:n_events - sizes.sum()]] += 1
+    return sizes
+
+
+def generate_cascade(rng: np.random.Generator, size: int, influence: np.ndarray, delay_scale: float,
+                     delay_alpha: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generate one cascade, the first event is the post of the root user, and each later event reposts an earlier
+    event, chosen in proportion to the influence of its user
+    :return: a tuple of (src, dst, time) of the events sorted by time
+    """
+    users = rng.choice(len(influence), size, p=influence)
+    parents = np.zeros(size, dtype=np.int64)
+    times = np.zeros(size)
+    weights = np.cumsum(influence[users])
+    for k in range(1, size):
+        parents[k] = np.searchsorted(weights[:k], rng.random() * weights[k - 1], side='right')
+    # Lomax delays, the parents come first so their times are known
+    delays = delay_scale * (rng.random(size) ** (-1. / delay_alpha) - 1.)
+    for k in range(1, size):
+        times[k] = times[parents[k]] + delays[k]
+    order = np.argsort(times, kind='stable')
+    return users[parents][order], users[order], times[order]
+
+
+def generate(n_user: int, n_cas: int, n_events: int, time_unit: float = 3600., horizon: float = 24.,
+             span: float = 30 * 86400., start: float = 1.5e9, size_sigma: float = 1.5, influence_alpha: float = 1.2,
+             delay_scale: float = 0.5, delay_alpha: float = 1.5, seed: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    :param time_unit: the number of seconds of a time unit
+    :param horizon: the events later than `horizon` time units after the publication are dropped
+    :param span: the publication times are uniform in [start, start + span] seconds
+    :param size_sigma: the sigma of the lognormal sizes of cascades, larger for more skewed sizes
+    :param influence_alpha: the exponent of the Zipf influence of users, larger for more skewed influence
+    :param delay_scale: the scale of the repost delays in time units
+    :param delay_alpha: the exponent of the power-law tail of the repost delays
+    :return: a tuple of (interactions, metadata)
+    """
+    if n_events < n_cas:
+        raise ValueError(f'{n_events} events can not make {n_cas} cascades')
+    rng = np.random.default_rng(seed)
+    influence = 1. / np.arange(1, n_user + 1) ** influence_alpha
+    influence = influence[rng.permutation(n_user)] / influence.sum()
+    pub_times = np.sort(np.round(start + rng.random(n_cas) * span).astype(np.int64))
+    columns = {'src': [], 'dst': [], 'cas': [], 'time': []}
+    for cas, size in enumerate(get_sizes(rng, n_cas, n_events, size_sigma)):
+        src, dst, times = generate_cascade(rng, size, influence, delay_scale * time_unit, delay_alpha)
+        keep = times <= horizon * time_unit
+        columns['src'].append(src[keep])
+        columns['dst'].append(dst[keep])
+        columns['cas'].append(np.full(keep.sum(), cas))
+        columns['time'].append(times[keep].round().astype(np.int64))
+    interactions = pd.DataFrame({name: np.concatenate(column) for name, column in columns.items()})
+    order = np.argsort(pub_times[interactions['cas'].values] + interactions['time'].values, kind='stable')
+    interactions = interactions.iloc[order].reset_index(drop=True)
+    interactions.insert(0, 'id', np.arange(len(interactions)))
+    metadata = pd.DataFrame({'casid': np.arange(n_cas), 'pub_time': pub_times})
+    return interactions, metadata
+
+
+def save(name: str, interactions: pd.DataFrame, metadata: pd.DataFrame, path: str = 'data'):
+    os.makedirs(path, exist_ok=True)
+    interactions.to_csv(os.path.join(path, f'{name}.csv'), index=False)
+    metadata.to_csv(os.path.join(path, f'{name}_metadata.csv'), index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser('generate a synthetic cascade dataset')
+    parser.add_argument('--name', type=str, default='synthetic', help='dataset name')
+    parser.add_argument('--users', type=int, default=10000, help='number of users')
+    parser.add_argument('--cascades', type=int, default=2000, help='number of cascades')
+    parser.add_argument('--events', type=int, default=200000,
+                        help='number of generated events, the ones after the horizon are dropped')
+    parser.add_argument('--time_unit', type=float, default=3600., help='number of seconds of a time unit')
+    parser.add_argument('--horizon', type=float, default=24., help='the length of cascades in time units')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    interactions, metadata = generate(args.users, args.cascades, args.events, time_unit=args.time_unit,
+                                      horizon=args.horizon, seed=args.seed)
+    save(args.name, interactions, metadata)
+    print(f'wrote {len(interactions)} interactions of {len(metadata)} cascades to data/{args.name}.csv')
+
+
+if __name__ == '__main__':
+    main()
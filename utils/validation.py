@@ -0,0 +1,55 @@
+import torch
+from typing import Sequence
+
+
+class ValidationError(RuntimeError):
+    """raised by a failed check, `stage` names the part of the model that produced the invalid values"""
+
+    def __init__(self, stage: str, message: str):
+        super(ValidationError, self).__init__(f'{stage}: {message}')
+        self.stage = stage
+        self.message = message
+
+
+class Validator:
+    """
+    Check the intermediate results of the model for NaN values and timing violations. With level 'off' nothing is
+    checked, with 'sampled' every check of one batch out of `interval` batches is run, and with 'full' every check
+    of every batch is run. The first failed check raises a ValidationError naming its stage.
+    """
+
+    def __init__(self, level: str = 'sampled', interval: int = 100):
+        if level not in ['off', 'sampled', 'full']:
+            raise ValueError("Check level {} not supported".format(level))
+        self.level = level
+        self.interval = max(interval, 1)
+        self.n_batch = 0
+        # whether the current batch is checked, read by the callers before doing any validation work
+        self.enabled = level == 'full'
+
+    def step(self):
+        """move to the next batch"""
+        if self.level == 'sampled':
+            self.enabled = self.n_batch % self.interval == 0
+        self.n_batch += 1
+
+    def check_nan(self, stage: str, *tensors: torch.Tensor):
+        for tensor in tensors:
+            if torch.isnan(tensor).any():
+                raise ValidationError(stage, f'NaN values in a tensor of shape {tuple(tensor.shape)}')
+
+    def check_cached(self, stage: str, node_ids: torch.Tensor, slot: torch.Tensor):
+        """check that every node has a cached state, the slot -1 of an uncached node reads another node's state"""
+        missing = slot < 0
+        if missing.any():
+            raise ValidationError(stage, f'nodes {node_ids[missing].tolist()} are not cached')
+
+    def check_time_order(self, stage: str, node_ids: Sequence[int], last_update_time: torch.Tensor,
+                         timestamps: torch.Tensor):
+        """check that no node is updated to a time before its last update"""
+        illegal = last_update_time > timestamps
+        if illegal.any():
+            node_ids = torch.as_tensor(node_ids)[illegal.cpu()]
+            raise ValidationError(stage, f'trying to update state to time in the past, nodes {node_ids.tolist()}, '
+                                         f'last updates {last_update_time[illegal].tolist()}, '
+                                         f'timestamps {timestamps[illegal].tolist()}')